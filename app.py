@@ -2,10 +2,15 @@ import os
 import warnings
 from flask import Flask
 from dotenv import load_dotenv
-from extensions import db, auth, socketio
-from utils import init_database, cleanup_old_files
+from extensions import db, socketio, database_engine_options, init_database_profile
+from utils import init_database
 from routes import init_routes
 from sockets import init_socket_handlers
+from auth import init_auth_cache, init_ldap_pool
+from presence import init_presence
+from message_writer import init_message_writer
+from file_reaper import file_reaper, init_file_reaper
+from thumbnails import init_thumbnails
 
 # Игнорируем предупреждения
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -20,9 +25,46 @@ app.config.update(
     SESSION_COOKIE_SAMESITE='Lax',
     SQLALCHEMY_DATABASE_URI=os.getenv('DATABASE_URI', 'sqlite:///social.db'),
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', 10)),
+    DB_MAX_OVERFLOW=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+    DB_POOL_TIMEOUT=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    DB_POOL_RECYCLE=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    DB_POOL_PRE_PING=os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    DB_POOL_SLOW_CHECKOUT=float(os.getenv('DB_POOL_SLOW_CHECKOUT', 0.1)),
+    SQLITE_JOURNAL_MODE=os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    SQLITE_BUSY_TIMEOUT=int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),
+    SQLITE_SYNCHRONOUS=os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    SQLITE_CACHE_SIZE=int(os.getenv('SQLITE_CACHE_SIZE', -65536)),
+    SQLITE_MMAP_SIZE=int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
     UPLOAD_FOLDER=os.getenv('UPLOAD_FOLDER', 'uploads'),
+    # Хранилище содержимого файлов по SHA-256 (дедупликация)
+    BLOB_FOLDER=os.getenv('BLOB_FOLDER', os.path.join(os.getenv('UPLOAD_FOLDER', 'uploads'), 'blobs')),
+    # Блоб без ссылок, которого касалась загрузка за этот период (секунды), пока не удаляется
+    BLOB_GRACE_PERIOD=int(os.getenv('BLOB_GRACE_PERIOD', 3600)),
     MAX_CONTENT_LENGTH=int(os.getenv('MAX_FILE_SIZE', 16 * 1024 * 1024)),
+    # Загрузка по частям: размер части должен быть меньше MAX_CONTENT_LENGTH
+    UPLOAD_CHUNK_SIZE=int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024)),
+    UPLOAD_MAX_FILE_SIZE=int(os.getenv('UPLOAD_MAX_FILE_SIZE', 1024 * 1024 * 1024)),
+    UPLOAD_PARTIAL_TTL=int(os.getenv('UPLOAD_PARTIAL_TTL', 24)),
     FILE_LIFETIME=int(os.getenv('FILE_LIFETIME', 7)),
+    # Отдача файлов фронт-прокси: X-Sendfile (Apache/lighttpd) или префикс internal-локации nginx
+    USE_X_SENDFILE=os.getenv('USE_X_SENDFILE', 'false').lower() in ('1', 'true', 'yes'),
+    DOWNLOAD_ACCEL_REDIRECT=os.getenv('DOWNLOAD_ACCEL_REDIRECT'),
+    # Фоновая очистка старых файлов: период в секундах (0 - только flask reap-files), размер пачки, потоки
+    FILE_REAPER_INTERVAL=int(os.getenv('FILE_REAPER_INTERVAL', 3600)),
+    FILE_REAPER_BATCH_SIZE=int(os.getenv('FILE_REAPER_BATCH_SIZE', 500)),
+    FILE_REAPER_WORKERS=int(os.getenv('FILE_REAPER_WORKERS', 4)),
+    FILE_REAPER_DRY_RUN=os.getenv('FILE_REAPER_DRY_RUN', 'false').lower() in ('1', 'true', 'yes'),
+    # Миниатюры изображений (нужен Pillow): размеры по длинной стороне, пул и очередь обработки
+    THUMBNAILS_ENABLED=os.getenv('THUMBNAILS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    THUMBNAIL_SMALL_SIZE=int(os.getenv('THUMBNAIL_SMALL_SIZE', 320)),
+    THUMBNAIL_LARGE_SIZE=int(os.getenv('THUMBNAIL_LARGE_SIZE', 1280)),
+    THUMBNAIL_WORKERS=int(os.getenv('THUMBNAIL_WORKERS', 2)),
+    THUMBNAIL_QUEUE_SIZE=int(os.getenv('THUMBNAIL_QUEUE_SIZE', 100)),
+    THUMBNAIL_WAIT=float(os.getenv('THUMBNAIL_WAIT', 5)),
+    THUMBNAIL_MAX_SOURCE_SIZE=int(os.getenv('THUMBNAIL_MAX_SOURCE_SIZE', 50 * 1024 * 1024)),
+    # Конфигурация текстового поиска PostgreSQL (для SQLite используется FTS5)
+    SEARCH_TS_CONFIG=os.getenv('SEARCH_TS_CONFIG', 'russian'),
     LDAP_SERVER=os.getenv('LDAP_SERVER'),
     LDAP_DOMAIN=os.getenv('LDAP_DOMAIN'),
     LDAP_SEARCH_BASE=os.getenv('LDAP_SEARCH_BASE'),
@@ -30,10 +72,40 @@ app.config.update(
     LDAP_ADMIN_GROUP=os.getenv('LDAP_ADMIN_GROUP'),
     LDAP_SERVICE_ACCOUNT=os.getenv('LDAP_SERVICE_ACCOUNT'),
     LDAP_SERVICE_PASSWORD=os.getenv('LDAP_SERVICE_PASSWORD'),
+    LDAP_POOL_SIZE=int(os.getenv('LDAP_POOL_SIZE', 4)),
+    LDAP_POOL_MAX_IDLE=int(os.getenv('LDAP_POOL_MAX_IDLE', 300)),
+    LDAP_CLIENT_STRATEGY=os.getenv('LDAP_CLIENT_STRATEGY', 'SYNC'),
+    LDAP_GROUP_CACHE_TTL=int(os.getenv('LDAP_GROUP_CACHE_TTL', 600)),
+    LDAP_PAGE_SIZE=int(os.getenv('LDAP_PAGE_SIZE', 1000)),
+    SYNC_BATCH_SIZE=int(os.getenv('SYNC_BATCH_SIZE', 500)),
+    SYNC_FULL_INTERVAL=int(os.getenv('SYNC_FULL_INTERVAL', 24)),
+    SYNC_WHENCHANGED_MARGIN=int(os.getenv('SYNC_WHENCHANGED_MARGIN', 300)),
+    FEED_CACHE_TTL=int(os.getenv('FEED_CACHE_TTL', 30)),
+    UNREAD_PUSH_WINDOW=float(os.getenv('UNREAD_PUSH_WINDOW', 0.3)),
+    AUTH_CACHE_TTL=int(os.getenv('AUTH_CACHE_TTL', 300)),
+    AUTH_CACHE_SIZE=int(os.getenv('AUTH_CACHE_SIZE', 1024)),
+    PRESENCE_BACKEND=os.getenv('PRESENCE_BACKEND', 'memory'),
+    PRESENCE_REDIS_URL=os.getenv('PRESENCE_REDIS_URL', 'redis://localhost:6379/0'),
+    PRESENCE_TTL=int(os.getenv('PRESENCE_TTL', 90)),
+    PRESENCE_HEARTBEAT_INTERVAL=int(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', 30)),
+    PRESENCE_DEBOUNCE=float(os.getenv('PRESENCE_DEBOUNCE', 0.5)),
+    PRESENCE_PROFILE_TTL=int(os.getenv('PRESENCE_PROFILE_TTL', 300)),
+    # Очередь сообщений Socket.IO (redis://, amqp://, ...) обязательна при нескольких воркерах
+    SOCKETIO_MESSAGE_QUEUE=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None,
+    SOCKETIO_CHANNEL=os.getenv('SOCKETIO_CHANNEL', 'flask-socketio'),
+    MESSAGE_WRITE_BEHIND=os.getenv('MESSAGE_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes'),
+    MESSAGE_QUEUE_SIZE=int(os.getenv('MESSAGE_QUEUE_SIZE', 1000)),
+    MESSAGE_QUEUE_TIMEOUT=float(os.getenv('MESSAGE_QUEUE_TIMEOUT', 2)),
+    MESSAGE_BATCH_SIZE=int(os.getenv('MESSAGE_BATCH_SIZE', 200)),
+    MESSAGE_BATCH_WINDOW=float(os.getenv('MESSAGE_BATCH_WINDOW', 0.05)),
 )
 
+# Параметры пула и прагмы SQLite должны быть заданы до создания движка в db.init_app
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database_engine_options(app.config))
+
 # Инициализация расширений
 db.init_app(app)
+init_database_profile(app)
 socketio.init_app(
     app,
     async_mode='eventlet',
@@ -43,11 +115,22 @@ socketio.init_app(
     ping_timeout=300,
     ping_interval=60,
     max_http_buffer_size=100 * 1024 * 1024,
-    manage_session=False
+    manage_session=False,
+    message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+    channel=app.config['SOCKETIO_CHANNEL']
 )
 
+init_auth_cache(app)
+# Очередь пула создается драйвером Socket.IO, чтобы ожидание не блокировало eventlet
+init_ldap_pool(app, socketio.server.eio.create_queue)
+init_presence(app)
+init_message_writer(app, socketio)
+init_file_reaper(app, socketio)
+init_thumbnails(app, socketio)
+
 # Создаем папку для загрузок
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['BLOB_FOLDER'], exist_ok=True)
 
 # Инициализация компонентов
 init_socket_handlers(socketio)
@@ -56,13 +139,13 @@ init_routes(app, socketio)
 # Инициализация приложения
 def init_app():
     init_database(db, app)
-    with app.app_context():
-        cleanup_old_files(app)
     print("🚀 Приложение инициализировано")
 
 # Запуск приложения
 if __name__ == '__main__':
     init_app()
+    # Очистка старых файлов идет в фоне и не задерживает запуск
+    file_reaper.start(app)
     socketio.run(
         app,
         host='0.0.0.0',
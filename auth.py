@@ -1,148 +1,431 @@
 # auth.py
 import os
+import hmac
+import time
+import hashlib
 import datetime
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
 from flask import session
-from ldap3 import Server, Connection, ALL, NTLM, SIMPLE, SUBTREE
+from ldap3 import Server, Connection, ALL, NTLM, SIMPLE, BASE, SUBTREE, SYNC
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
 from extensions import auth, db
-from models import User
+from models import User, SyncState
+from utils import set_current_user, invalidate_presence_profiles
 from flask import current_app
 
-def get_ldap_connection(username=None, password=None, service_auth=False):
-    server = Server(
-        current_app.config['LDAP_SERVER'],
-        get_info=ALL,
-        connect_timeout=5
+class VerificationCache:
+    """Кэш успешных проверок учетных данных с TTL и вытеснением LRU"""
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._salt = os.urandom(16)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _key(self, username, password):
+        digest = hmac.new(self._salt, f"{username}\0{password}".encode('utf-8'), hashlib.sha256)
+        return username.lower(), digest.hexdigest()
+
+    def get(self, username, password):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return None
+
+        key = self._key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry['expires_at'] <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, username, password, user_id, is_admin, attributes):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        key = self._key(username, password)
+        with self._lock:
+            # Один пользователь - одна запись, старый пароль сразу перестает действовать
+            for stale_key in [k for k in self._entries if k[0] == key[0]]:
+                del self._entries[stale_key]
+            self._entries[key] = {
+                'user_id': user_id,
+                'is_admin': is_admin,
+                'attributes': attributes,
+                'expires_at': time.monotonic() + self.ttl
+            }
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == username.lower()]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0
+            }
+
+
+verification_cache = VerificationCache()
+
+
+def init_auth_cache(app):
+    verification_cache.configure(
+        max_size=app.config['AUTH_CACHE_SIZE'],
+        ttl=app.config['AUTH_CACHE_TTL']
     )
 
-    if service_auth:
-        username = current_app.config['LDAP_SERVICE_ACCOUNT']
-        password = current_app.config['LDAP_SERVICE_PASSWORD']
 
+class LDAPServicePool:
+    """Пул соединений сервисной учетной записи LDAP.
+
+    Запоминает удачный формат логина и механизм аутентификации, читает
+    схему и DSA-info сервера только при первом подключении и
+    переподключает соединения, которые простаивали слишком долго или
+    были разорваны сервером.
+    """
+
+    def __init__(self):
+        self.size = 4
+        self.max_idle = 300
+        self.client_strategy = SYNC
+        self._server = None
+        self._server_address = None
+        self._info_loaded = False
+        self._bind_params = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def configure(self, app, queue_factory=None):
+        with self._lock:
+            self.size = app.config['LDAP_POOL_SIZE']
+            self.max_idle = app.config['LDAP_POOL_MAX_IDLE']
+            self.client_strategy = app.config['LDAP_CLIENT_STRATEGY']
+            self._server = None
+            self._info_loaded = False
+            self._bind_params = None
+            self._slots = (queue_factory or queue.Queue)()
+            for _ in range(self.size):
+                self._slots.put(None)
+
+    @property
+    def server(self):
+        address = current_app.config['LDAP_SERVER']
+        with self._lock:
+            if self._server is None or self._server_address != address:
+                self._server = Server(address, get_info=ALL, connect_timeout=5)
+                self._server_address = address
+                self._info_loaded = False
+            return self._server
+
+    def bind(self, user, password, authentication):
+        """Открывает и аутентифицирует соединение, схема читается один раз"""
+        server = self.server
+        conn = Connection(
+            server,
+            user=user,
+            password=password,
+            authentication=authentication,
+            client_strategy=self.client_strategy,
+            raise_exceptions=False
+        )
+        try:
+            conn.open(read_server_info=False)
+            read_info = not self._info_loaded
+            if not conn.bind(read_server_info=read_info):
+                conn.unbind()
+                return None
+            if read_info:
+                self._info_loaded = True
+            conn.pool_bound_at = time.monotonic()
+            return conn
+        except Exception:
+            try:
+                conn.unbind()
+            except Exception:
+                pass
+            raise
+
+    def _candidates(self):
+        username = current_app.config['LDAP_SERVICE_ACCOUNT']
+        domain = current_app.config['LDAP_DOMAIN']
         formats = [
-            f"{username}@{current_app.config['LDAP_DOMAIN']}",
-            f"{current_app.config['LDAP_DOMAIN']}\\{username}",
+            f"{username}@{domain}",
+            f"{domain}\\{username}",
             f"CN={username},{current_app.config['LDAP_USER_OU']}"
         ]
+        return [(user_dn, mechanism) for mechanism in (NTLM, SIMPLE) for user_dn in formats]
+
+    def connect(self):
+        """Новое соединение сервисной учетной записи (вне пула)"""
+        password = current_app.config['LDAP_SERVICE_PASSWORD']
 
-        for user_dn in formats:
+        if self._bind_params:
+            user_dn, mechanism = self._bind_params
             try:
-                conn = Connection(
-                    server,
-                    user=user_dn,
-                    password=password,
-                    authentication=NTLM,
-                    auto_bind=True
-                )
-                if conn.bound:
+                conn = self.bind(user_dn, password, mechanism)
+                if conn:
                     return conn
-            except Exception:
-                continue
+            except Exception as e:
+                print(f"⚠️ Ошибка повторной аутентификации сервисной учетной записи: {str(e)}")
+            self._bind_params = None
 
-        for user_dn in formats:
+        for user_dn, mechanism in self._candidates():
             try:
-                conn = Connection(
-                    server,
-                    user=user_dn,
-                    password=password,
-                    authentication=SIMPLE,
-                    auto_bind=True
-                )
-                if conn.bound:
+                conn = self.bind(user_dn, password, mechanism)
+                if conn:
+                    self._bind_params = (user_dn, mechanism)
+                    print(f"🔑 Сервисная учетная запись LDAP: {user_dn} ({mechanism})")
                     return conn
             except Exception as e:
-                print(f"⚠️ Ошибка SIMPLE аутентификации: {str(e)}")
+                if mechanism == SIMPLE:
+                    print(f"⚠️ Ошибка SIMPLE аутентификации: {str(e)}")
 
         raise Exception("❌ Все попытки аутентификации не удались")
-    else:
-        user_dn = f"{username}@{current_app.config['LDAP_DOMAIN']}"
+
+    def _is_stale(self, conn):
+        if conn.closed or not conn.bound:
+            return True
+        return time.monotonic() - getattr(conn, 'pool_bound_at', 0) > self.max_idle
+
+    def acquire(self, timeout=10):
+        if self._slots is None:
+            self.configure(current_app)
         try:
-            return Connection(
-                server,
-                user=user_dn,
-                password=password,
-                authentication=NTLM,
-                auto_bind=True
-            )
+            conn = self._slots.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception("❌ Нет свободных соединений LDAP в пуле")
+
+        try:
+            if conn is not None and self._is_stale(conn):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+            return conn
         except Exception:
-            try:
-                return Connection(
-                    server,
-                    user=user_dn,
-                    password=password,
-                    authentication=SIMPLE,
-                    auto_bind=True
-                )
-            except Exception as e:
+            self._slots.put(None)
+            raise
+
+    def release(self, conn, discard=False):
+        if discard:
+            self._close(conn)
+            conn = None
+        else:
+            conn.pool_bound_at = time.monotonic()
+        self._slots.put(conn)
+
+    def _close(self, conn):
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+
+ldap_pool = LDAPServicePool()
+
+
+def init_ldap_pool(app, queue_factory=None):
+    ldap_pool.configure(app, queue_factory)
+
+
+@contextmanager
+def service_connection():
+    """Соединение сервисной учетной записи из пула"""
+    conn = ldap_pool.acquire()
+    try:
+        yield conn
+    except LDAPCommunicationError:
+        ldap_pool.release(conn, discard=True)
+        raise
+    except Exception:
+        ldap_pool.release(conn, discard=conn.closed)
+        raise
+    else:
+        ldap_pool.release(conn, discard=conn.closed)
+
+
+def get_ldap_connection(username=None, password=None, service_auth=False):
+    if service_auth:
+        return ldap_pool.connect()
+
+    user_dn = f"{username}@{current_app.config['LDAP_DOMAIN']}"
+    for mechanism in (NTLM, SIMPLE):
+        try:
+            conn = ldap_pool.bind(user_dn, password, mechanism)
+            if conn:
+                return conn
+        except Exception as e:
+            if mechanism == SIMPLE:
                 print(f"⚠️ Ошибка аутентификации пользователя: {str(e)}")
-                return None
+    return None
 
 def get_user_ldap_attributes(username, attributes):
     try:
-        conn = get_ldap_connection(service_auth=True)
-        search_filter = f"(sAMAccountName={username})"
-        conn.search(
-            current_app.config['LDAP_SEARCH_BASE'],
-            search_filter,
-            attributes=attributes
-        )
-        if conn.entries:
-            return conn.entries[0]
-        return None
+        with service_connection() as conn:
+            search_filter = f"(sAMAccountName={escape_filter_chars(username)})"
+            conn.search(
+                current_app.config['LDAP_SEARCH_BASE'],
+                search_filter,
+                attributes=attributes
+            )
+            if conn.entries:
+                return conn.entries[0]
+            return None
     except Exception as e:
         print(f"⚠️ Ошибка поиска в LDAP: {str(e)}")
         return None
 
-def is_user_in_group(username, group_dn):
-    try:
-        user_attrs = get_user_ldap_attributes(username, ['distinguishedName'])
-        if not user_attrs or not hasattr(user_attrs, 'distinguishedName'):
-            return False
+# Правило LDAP_MATCHING_RULE_IN_CHAIN: членство с учетом вложенных групп
+IN_CHAIN = '1.2.840.113556.1.4.1941'
 
-        user_dn = user_attrs.distinguishedName.value
+USER_ATTRIBUTES = ['displayName', 'mail', 'department', 'title', 'memberOf']
 
-        conn = get_ldap_connection(service_auth=True)
-        search_filter = f"(&(objectClass=group)(distinguishedName={group_dn})(member={user_dn}))"
-        conn.search(
-            current_app.config['LDAP_SEARCH_BASE'],
-            search_filter,
-            attributes=['cn']
-        )
-        return bool(conn.entries)
+_admin_groups = {'groups': None, 'expires_at': 0}
+
+
+def get_admin_groups():
+    """Группа администраторов и все вложенные в нее группы (кэшируется)"""
+    admin_group = current_app.config['LDAP_ADMIN_GROUP']
+    if not admin_group:
+        return set()
+
+    if _admin_groups['groups'] is not None and _admin_groups['expires_at'] > time.monotonic():
+        return _admin_groups['groups']
+
+    groups = {admin_group.lower()}
+    try:
+        with service_connection() as conn:
+            conn.search(
+                current_app.config['LDAP_SEARCH_BASE'],
+                f"(&(objectClass=group)(memberOf:{IN_CHAIN}:={escape_filter_chars(admin_group)}))",
+                attributes=['distinguishedName']
+            )
+            groups.update(entry.entry_dn.lower() for entry in conn.entries)
     except Exception as e:
-        print(f"⚠️ Ошибка проверки группы LDAP: {str(e)}")
-        return False
+        print(f"⚠️ Ошибка получения вложенных групп администраторов: {str(e)}")
+        if _admin_groups['groups'] is not None:
+            return _admin_groups['groups']
+        return groups
+
+    _admin_groups['groups'] = groups
+    _admin_groups['expires_at'] = time.monotonic() + current_app.config['LDAP_GROUP_CACHE_TTL']
+    return groups
+
+def get_admin_usernames(conn):
+    """Все пользователи группы администраторов, включая вложенные группы, одним поиском"""
+    admin_group = current_app.config['LDAP_ADMIN_GROUP']
+    if not admin_group:
+        return set()
+
+    admins = set()
+    for attrs in paged_search(
+            conn,
+            current_app.config['LDAP_SEARCH_BASE'],
+            f"(&(objectClass=user)(memberOf:{IN_CHAIN}:={escape_filter_chars(admin_group)}))",
+            ['sAMAccountName']):
+        username = entry_value(attrs, 'sAMAccountName')
+        if username:
+            admins.add(username.lower())
+    return admins
 
 @auth.verify_password
 def verify_password(username, password):
+    if not username or not password:
+        return None
+
+    cached = verification_cache.get(username, password)
+    if cached:
+        # Кэш экономит обращение к LDAP, но не к БД: sync-ad работает в отдельном процессе
+        # и не может очистить кэш сервера, поэтому активность и права читаются из строки User.
+        # Строка загружается один раз и становится текущим пользователем запроса
+        user = db.session.get(User, cached['user_id'])
+        if user and user.is_active:
+            session['user_id'] = user.id
+            session['is_admin'] = user.is_admin
+            set_current_user(user)
+            return username
+        verification_cache.invalidate(username)
+
     try:
         conn = get_ldap_connection(username, password)
         if not conn or not conn.bound:
             print(f"⚠️ Не удалось подключиться к LDAP для пользователя {username}")
             return None
+        conn.unbind()
 
-        ldap_user = get_user_ldap_attributes(username,
-                                             ['displayName', 'mail', 'department', 'title'])
+        ldap_user = get_user_ldap_attributes(username, USER_ATTRIBUTES)
 
         if not ldap_user:
             print(f"⚠️ Пользователь {username} не найден в LDAP")
             return None
 
+        attributes = {
+            'fullname': get_ldap_attr(ldap_user, 'displayName', username),
+            'email': get_ldap_attr(ldap_user, 'mail', ''),
+            'department': get_ldap_attr(ldap_user, 'department', ''),
+            'position': get_ldap_attr(ldap_user, 'title', '')
+        }
+
         user = User.query.filter_by(username=username).first()
         if not user:
             user = User(username=username)
             db.session.add(user)
 
-        user.fullname = getattr(ldap_user, 'displayName', username)
-        user.email = getattr(ldap_user, 'mail', '')
-        user.department = getattr(ldap_user, 'department', '')
-        user.position = getattr(ldap_user, 'title', '')
+        user.fullname = attributes['fullname']
+        user.email = attributes['email']
+        user.department = attributes['department']
+        user.position = attributes['position']
+        member_of = {dn.lower() for dn in get_ldap_values(ldap_user, 'memberOf')}
+        is_admin = bool(member_of & get_admin_groups())
+
         user.is_active = True
+        user.is_admin = is_admin
         user.last_seen = datetime.datetime.utcnow()
 
         db.session.commit()
 
         session['user_id'] = user.id
-        session['is_admin'] = is_user_in_group(username, current_app.config['LDAP_ADMIN_GROUP'])
+        session['is_admin'] = is_admin
+        set_current_user(user)
+
+        verification_cache.put(username, password, user.id, is_admin, attributes)
 
         print(f"✅ Успешная аутентификация: {username}")
         return username
@@ -156,68 +439,269 @@ def get_ldap_attr(entry, attr_name, default=None):
         return getattr(entry, attr_name).value
     return default
 
-def sync_ad_users():
+def get_ldap_values(entry, attr_name):
+    """Все значения многозначного атрибута LDAP-записи"""
+    if hasattr(entry, attr_name):
+        return list(getattr(entry, attr_name).values)
+    return []
+
+def paged_search(conn, search_base, search_filter, attributes):
+    """Постраничный поиск (Simple Paged Results), возвращает атрибуты записей"""
+    results = conn.extend.standard.paged_search(
+        search_base=search_base,
+        search_filter=search_filter,
+        search_scope=SUBTREE,
+        attributes=attributes,
+        paged_size=current_app.config['LDAP_PAGE_SIZE'],
+        generator=True
+    )
+    for result in results:
+        if result.get('type') == 'searchResEntry':
+            yield result['attributes']
+
+def entry_value(attrs, attr_name, default=None):
+    """Безопасное извлечение значения из атрибутов записи постраничного поиска"""
+    value = attrs.get(attr_name)
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return value if value else default
+
+SYNC_FIELDS = ('fullname', 'email', 'department', 'position', 'is_active')
+
+SYNC_STATE_NAME = 'ad_users'
+
+def get_directory_watermark(conn):
+    """Имя контроллера домена и его highestCommittedUSN из rootDSE"""
+    conn.search('', '(objectClass=*)', search_scope=BASE,
+                attributes=['dnsHostName', 'highestCommittedUSN'])
+    if not conn.entries:
+        return None, None
+    attrs = conn.entries[0].entry_attributes_as_dict
+    dc_host = entry_value(attrs, 'dnsHostName')
+    usn = entry_value(attrs, 'highestCommittedUSN')
+    return dc_host, int(usn) if usn is not None else None
+
+def sync_ad_users(full=None):
+    """Синхронизация пользователей AD.
+
+    full=None - полная синхронизация, если она не выполнялась дольше
+    SYNC_FULL_INTERVAL часов, иначе инкрементальная по uSNChanged
+    (или whenChanged, если контроллер домена сменился).
+    """
+    started = time.perf_counter()
+    started_at = datetime.datetime.utcnow()
     try:
         with current_app.app_context():
-            ous = current_app.config['LDAP_USER_OU'].split(';')
-            active_users = []
-            conn = get_ldap_connection(service_auth=True)
-
-            for ou in ous:
-                ou = ou.strip()
-                if not ou:
-                    continue
-
-                try:
-                    print(f"🔍 Поиск пользователей в OU: {ou}")
-                    conn.search(
-                        search_base=ou,
-                        search_filter='(objectClass=user)',
-                        attributes=['sAMAccountName', 'displayName', 'mail', 'department', 'title'],
-                        search_scope=SUBTREE
+            ous = [ou.strip() for ou in current_app.config['LDAP_USER_OU'].split(';') if ou.strip()]
+            batch_size = current_app.config['SYNC_BATCH_SIZE']
+
+            state = SyncState.query.filter_by(name=SYNC_STATE_NAME).first()
+            if state is None:
+                state = SyncState(name=SYNC_STATE_NAME)
+                db.session.add(state)
+
+            if full is None:
+                full_interval = datetime.timedelta(hours=current_app.config['SYNC_FULL_INTERVAL'])
+                full = not state.last_full_sync or started_at - state.last_full_sync >= full_interval
+            elif not full and not state.last_sync:
+                # Без сохраненной отметки инкрементальная синхронизация невозможна; решаем до
+                # загрузки existing, иначе полный проход вставил бы уже существующих пользователей
+                full = True
+                print("🔁 Нет сохраненной отметки, выполняется полная синхронизация")
+
+            existing = {}
+            if full:
+                existing = {
+                    row.username.lower(): row
+                    for row in db.session.query(
+                        User.id, User.username, User.fullname, User.email, User.department,
+                        User.position, User.is_active
                     )
+                }
+                print(f"📦 Загружено пользователей из БД: {len(existing)} "
+                      f"за {time.perf_counter() - started:.2f} с")
+
+            seen = set()
+            pending = []
+            stats = {'entries': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+            failed_ous = []
+
+            def flush():
+                if not pending:
+                    return
+                if full:
+                    rows = existing
+                else:
+                    rows = {
+                        row.username.lower(): row
+                        for row in db.session.query(
+                            User.id, User.username, User.fullname, User.email, User.department,
+                            User.position, User.is_active
+                        ).filter(db.func.lower(User.username).in_(
+                            [values['username'].lower() for values in pending]))
+                    }
+
+                inserts = []
+                updates = []
+                for values in pending:
+                    row = rows.get(values['username'].lower())
+                    if row is None:
+                        inserts.append(values)
+                    elif any(getattr(row, field) != values[field] for field in SYNC_FIELDS):
+                        values = dict(values, id=row.id)
+                        del values['username']
+                        updates.append(values)
+                    else:
+                        stats['unchanged'] += 1
+
+                if inserts:
+                    db.session.bulk_insert_mappings(User, inserts)
+                    stats['inserted'] += len(inserts)
+                if updates:
+                    db.session.bulk_update_mappings(User, updates)
+                    stats['updated'] += len(updates)
+                pending.clear()
+
+            with service_connection() as conn:
+                try:
+                    dc_host, highest_usn = get_directory_watermark(conn)
+                except Exception as rootdse_error:
+                    dc_host, highest_usn = None, None
+                    print(f"⚠️ Не удалось прочитать rootDSE: {str(rootdse_error)}")
+
+                search_filter = '(objectClass=user)'
+                if full:
+                    print("🔁 Полная синхронизация")
+                elif state.highest_usn is not None and dc_host and dc_host == state.dc_host:
+                    search_filter = f"(&(objectClass=user)(uSNChanged>={state.highest_usn + 1}))"
+                    print(f"🔁 Инкрементальная синхронизация с {dc_host}, uSNChanged > {state.highest_usn}")
+                else:
+                    margin = datetime.timedelta(seconds=current_app.config['SYNC_WHENCHANGED_MARGIN'])
+                    since = (state.last_sync - margin).strftime('%Y%m%d%H%M%S.0Z')
+                    search_filter = f"(&(objectClass=user)(whenChanged>={since}))"
+                    print(f"🔁 Инкрементальная синхронизация по whenChanged >= {since}")
+
+                for ou in ous:
+                    ou_started = time.perf_counter()
+                    ou_entries = 0
+                    try:
+                        print(f"🔍 Поиск пользователей в OU: {ou}")
+                        for attrs in paged_search(
+                                conn, ou, search_filter,
+                                ['sAMAccountName', 'displayName', 'mail', 'department', 'title']):
+                            stats['entries'] += 1
+                            ou_entries += 1
+
+                            username = entry_value(attrs, 'sAMAccountName')
+                            if not username:
+                                print(f"⚠️ Пропуск записи без sAMAccountName")
+                                continue
+
+                            key = username.lower()
+                            if key in seen:
+                                stats['duplicates'] += 1
+                                continue
+                            seen.add(key)
+
+                            pending.append({
+                                'username': username,
+                                'fullname': entry_value(attrs, 'displayName', username),
+                                'email': entry_value(attrs, 'mail', ''),
+                                'department': entry_value(attrs, 'department', ''),
+                                'position': entry_value(attrs, 'title', ''),
+                                'is_active': True
+                            })
+
+                            if len(pending) >= batch_size:
+                                flush()
+
+                        elapsed = time.perf_counter() - ou_started
+                        print(f"📄 OU {ou}: {ou_entries} записей за {elapsed:.2f} с")
+                    except Exception as ou_error:
+                        failed_ous.append(ou)
+                        print(f"⚠️ Ошибка при обработке OU {ou}: {str(ou_error)}")
+                        continue
+
+                flush()
 
-                    for entry in conn.entries:
-                        username = get_ldap_attr(entry, 'sAMAccountName')
-                        if not username:
-                            print(f"⚠️ Пропуск записи без sAMAccountName")
-                            continue
-
-                        if username in active_users:
-                            print(f"⚠️ Пользователь {username} уже обработан, пропускаем дубликат")
-                            continue
-
-                        active_users.append(username)
-
-                        user = User.query.filter_by(username=username).first()
-                        if not user:
-                            user = User(username=username)
-                            db.session.add(user)
-                            print(f"➕ Добавлен новый пользователь: {username}")
-
-                        user.fullname = get_ldap_attr(entry, 'displayName', username)
-                        user.email = get_ldap_attr(entry, 'mail', '')
-                        user.department = get_ldap_attr(entry, 'department', '')
-                        user.position = get_ldap_attr(entry, 'title', '')
-                        user.is_active = True
-
-                        print(f"🔄 Обновлен пользователь: {username} ({user.fullname})")
-
-                except Exception as ou_error:
-                    print(f"⚠️ Ошибка при обработке OU {ou}: {str(ou_error)}")
-                    continue
-
-            inactive_users = User.query.filter(User.username.notin_(active_users)).all()
-            for user in inactive_users:
-                user.is_active = False
-                print(f"⏸️ Пользователь деактивирован: {user.username}")
+                try:
+                    admin_usernames = get_admin_usernames(conn)
+                    print(f"🛡️ Администраторов в AD: {len(admin_usernames)}")
+                except Exception as admin_error:
+                    admin_usernames = None
+                    print(f"⚠️ Не удалось получить список администраторов: {str(admin_error)}")
+
+            if admin_usernames is not None:
+                sync_admin_flags(admin_usernames)
+
+            deactivated = 0
+            if full and failed_ous:
+                print(f"⚠️ Деактивация пропущена: не обработаны OU {', '.join(failed_ous)}")
+            elif full:
+                stale = [row for key, row in existing.items() if row.is_active and key not in seen]
+                stale_ids = [row.id for row in stale]
+                for i in range(0, len(stale_ids), batch_size):
+                    chunk = stale_ids[i:i + batch_size]
+                    db.session.query(User).filter(User.id.in_(chunk)).update(
+                        {User.is_active: False}, synchronize_session=False)
+                for row in stale:
+                    verification_cache.invalidate(row.username)
+                    print(f"⏸️ Пользователь деактивирован: {row.username}")
+                deactivated = len(stale)
+
+            # Отметку двигаем только после успешной обработки всех OU
+            if not failed_ous:
+                state.dc_host = dc_host
+                state.highest_usn = highest_usn
+                state.last_sync = started_at
+                if full:
+                    state.last_full_sync = started_at
 
             db.session.commit()
-            print(f"✅ Синхронизация завершена. Пользователей: {len(active_users)}, "
-                  f"Деактивировано: {len(inactive_users)}")
+            # Очищается только кэш этого процесса; сервер увидит новые профили
+            # не позже чем через PRESENCE_PROFILE_TTL
+            invalidate_presence_profiles()
+
+            elapsed = time.perf_counter() - started
+            rate = stats['entries'] / elapsed if elapsed else 0
+            print(f"✅ {'Полная' if full else 'Инкрементальная'} синхронизация завершена "
+                  f"за {elapsed:.2f} с ({rate:.0f} записей/с). "
+                  f"Пользователей: {len(seen)}, добавлено: {stats['inserted']}, "
+                  f"обновлено: {stats['updated']}, без изменений: {stats['unchanged']}, "
+                  f"дубликатов: {stats['duplicates']}, деактивировано: {deactivated}")
 
     except Exception as e:
         print(f"❌ Критическая ошибка синхронизации: {str(e)}")
         db.session.rollback()
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+
+def sync_admin_flags(admin_usernames):
+    """Приводит User.is_admin в соответствие с членством в группе администраторов"""
+    current = {
+        row.username.lower(): row
+        for row in db.session.query(User.id, User.username).filter(User.is_admin.is_(True))
+    }
+    revoke = [row for key, row in current.items() if key not in admin_usernames]
+    grant_names = admin_usernames - set(current)
+
+    revoked = 0
+    if revoke:
+        revoked = db.session.query(User).filter(User.id.in_([row.id for row in revoke])).update(
+            {User.is_admin: False}, synchronize_session=False)
+        for row in revoke:
+            verification_cache.invalidate(row.username)
+
+    granted = []
+    if grant_names:
+        # Только существующие пользователи, у которых флага еще нет
+        granted = db.session.query(User.id, User.username).filter(
+            db.func.lower(User.username).in_(grant_names), User.is_admin.isnot(True)).all()
+        if granted:
+            db.session.query(User).filter(User.id.in_([row.id for row in granted])).update(
+                {User.is_admin: True}, synchronize_session=False)
+            for row in granted:
+                verification_cache.invalidate(row.username)
+
+    if revoked or granted:
+        print(f"🛡️ Права администратора: выдано {len(granted)}, отозвано {revoked}")
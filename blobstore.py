@@ -0,0 +1,215 @@
+# blobstore.py
+import os
+import glob
+import time
+import fcntl
+import shutil
+import hashlib
+import secrets
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import Blob
+
+# Размер блока при хешировании и копировании
+COPY_BUFFER_SIZE = 64 * 1024
+TMP_DIR = 'tmp'
+LOCK_DIR = '.locks'
+
+
+def _tmp_path():
+    tmp_dir = os.path.join(current_app.config['BLOB_FOLDER'], TMP_DIR)
+    os.makedirs(tmp_dir, exist_ok=True)
+    return os.path.join(tmp_dir, secrets.token_hex(16))
+
+
+@contextmanager
+def _blob_lock(sha256):
+    """Межпроцессная блокировка блоба (по первым двум символам хеша), общая для _place и purge_blobs"""
+    lock_dir = os.path.join(current_app.config['BLOB_FOLDER'], LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, sha256[:2] + '.lock'), 'a') as lock_file:
+        # Блокировка держится миллисекунды; ожидание без блокирования потока - через sleep
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(0.01)
+        yield
+
+
+def _place(tmp_path, sha256):
+    """Переносит временный файл на место блоба; одинаковое содержимое хранится один раз.
+
+    Ссылка на блоб появится только при commit вызывающего; свежее время изменения не дает
+    purge_blobs и sweep_orphan_files удалить файл до этого (BLOB_GRACE_PERIOD).
+    """
+    path = Blob.path(sha256)
+    with _blob_lock(sha256):
+        if os.path.exists(path):
+            os.utime(path)
+            os.remove(tmp_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        os.utime(path)
+    return path
+
+
+def store_stream(stream):
+    """Сохраняет поток в хранилище, считая SHA-256 по ходу записи; возвращает (хеш, размер)"""
+    tmp_path = _tmp_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            while True:
+                block = stream.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                tmp_file.write(block)
+                size += len(block)
+        sha256 = digest.hexdigest()
+        _place(tmp_path, sha256)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sha256, size
+
+
+def store_file(path):
+    """Кладет готовый файл (например, собранную загрузку по частям) в хранилище.
+
+    Исходный файл остается на месте - вызывающий удаляет его после commit, чтобы при
+    ошибке операцию можно было повторить.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    tmp_path = _tmp_path()
+    try:
+        # Жесткая ссылка без копирования данных; копия - если BLOB_FOLDER на другом разделе
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    try:
+        _place(tmp_path, sha256)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sha256, os.path.getsize(Blob.path(sha256))
+
+
+def acquire(sha256, size):
+    """Добавляет ссылку на блоб в текущей транзакции (вызывается вместе с созданием File)"""
+    increment = update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount + 1)
+    if db.session.execute(increment).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(sha256=sha256, size=size, refcount=1))
+    except IntegrityError:
+        # Тот же блоб только что добавила параллельная загрузка
+        db.session.execute(increment)
+
+
+def release(sha256, count=1):
+    """Снимает ссылки на блоб; строку и файл удаляет purge_blobs после фиксации транзакции"""
+    db.session.execute(update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount - count))
+
+
+def purge_blobs(hashes=None):
+    """Удаляет блобы без ссылок (hashes=None - все такие блобы).
+
+    Возвращает (пути блобов, пути производных файлов) для удаления с диска.
+
+    Строка удаляется, а файл убирается из хранилища под блокировкой, общей с _place:
+    загрузка, нашедшая существующий файл, либо успевает обновить его время изменения
+    (и блоб остается до следующего прохода), либо уже не находит файл и кладет свой.
+    Файл переименовывается во временную папку - удалить его с диска можно вне блокировки.
+    """
+    query = Blob.query.filter(Blob.refcount <= 0)
+    if hashes is not None:
+        hashes = list(set(hashes))
+        if not hashes:
+            return [], []
+        query = query.filter(Blob.sha256.in_(hashes))
+    orphaned = [blob.sha256 for blob in query]
+    db.session.commit()
+
+    grace = current_app.config['BLOB_GRACE_PERIOD']
+    paths = []
+    derived = []
+    for sha256 in orphaned:
+        path = Blob.path(sha256)
+        with _blob_lock(sha256):
+            try:
+                if time.time() - os.path.getmtime(path) < grace:
+                    continue
+            except FileNotFoundError:
+                pass
+            deleted = Blob.query.filter(Blob.sha256 == sha256, Blob.refcount <= 0) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            if not deleted:
+                continue
+            if os.path.exists(path):
+                trash_path = _tmp_path()
+                os.replace(path, trash_path)
+                paths.append(trash_path)
+        # Вместе с блобом удаляются производные файлы рядом с ним (миниатюры)
+        derived.extend(glob.glob(glob.escape(path) + '.*'))
+    return paths, derived
+
+
+def sweep_orphan_files(batch_size=500):
+    """Файлы хранилища без строки Blob старше BLOB_GRACE_PERIOD.
+
+    Файл попадает на место до commit вызывающего; если транзакция не прошла, строки
+    нет и purge_blobs его не видит. Возвращает (пути блобов, пути производных файлов).
+    """
+    blob_folder = current_app.config['BLOB_FOLDER']
+    cutoff = time.time() - current_app.config['BLOB_GRACE_PERIOD']
+
+    files = {}
+    for path in glob.glob(os.path.join(glob.escape(blob_folder), '??', '??', '*')):
+        sha256 = os.path.basename(path).split('.', 1)[0]
+        if len(sha256) == 64:
+            files.setdefault(sha256, []).append(path)
+
+    hashes = list(files)
+    known = set()
+    for i in range(0, len(hashes), batch_size):
+        known.update(sha256 for sha256, in db.session.query(Blob.sha256)
+                     .filter(Blob.sha256.in_(hashes[i:i + batch_size])))
+    db.session.commit()
+
+    paths = []
+    derived = []
+    for sha256 in set(hashes) - known:
+        path = Blob.path(sha256)
+        with _blob_lock(sha256):
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+            except FileNotFoundError:
+                path = None
+            # Блоб мог получить строку после выборки выше
+            if db.session.query(Blob.sha256).filter(Blob.sha256 == sha256).first():
+                db.session.commit()
+                continue
+            db.session.commit()
+            if path:
+                trash_path = _tmp_path()
+                os.replace(path, trash_path)
+                paths.append(trash_path)
+        derived.extend(p for p in files[sha256] if p != Blob.path(sha256))
+    return paths, derived
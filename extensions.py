@@ -1,7 +1,112 @@
+import time
+import threading
 from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
 from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 
 db = SQLAlchemy()
 auth = HTTPBasicAuth()
-socketio = SocketIO()
\ No newline at end of file
+socketio = SocketIO()
+
+
+class PoolStats:
+    """Время ожидания свободного соединения в пуле БД"""
+
+    def __init__(self):
+        self.slow_threshold = 0.1
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.slow = 0
+        self._lock = threading.Lock()
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            slow = wait >= self.slow_threshold
+            if slow:
+                self.slow += 1
+        if slow:
+            print(f"🐢 Ожидание соединения из пула БД: {wait * 1000:.0f} мс")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'avg_wait_ms': round(self.total_wait / self.checkouts * 1000, 2) if self.checkouts else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+                'slow': self.slow,
+                'slow_threshold_ms': int(self.slow_threshold * 1000)
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, учитывающий время выдачи соединения в pool_stats"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record(time.perf_counter() - started)
+
+
+def database_engine_options(config):
+    """Параметры движка SQLAlchemy для выбранной БД (SQLALCHEMY_ENGINE_OPTIONS)"""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    pool_options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT']
+    }
+
+    if url.get_backend_name() == 'sqlite':
+        # БД в памяти живет в единственном соединении - пул не настраиваем
+        if url.database in (None, '', ':memory:'):
+            return {}
+        # Таймаут драйвера совпадает с busy_timeout: ждем блокировку, а не падаем с "database is locked"
+        pool_options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}
+        return pool_options
+
+    pool_options.update(
+        pool_recycle=config['DB_POOL_RECYCLE'],
+        pool_pre_ping=config['DB_POOL_PRE_PING']
+    )
+    return pool_options
+
+
+def init_database_profile(app):
+    """Прагмы SQLite на каждое новое соединение и порог медленной выдачи из пула"""
+    pool_stats.slow_threshold = app.config['DB_POOL_SLOW_CHECKOUT']
+
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = [
+        f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'])}",
+        f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size={int(app.config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}"
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
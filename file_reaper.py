@@ -0,0 +1,177 @@
+# file_reaper.py
+import os
+import time
+import datetime
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import delete
+from extensions import db
+from models import File
+from blobstore import release, purge_blobs, sweep_orphan_files
+from uploads import cleanup_partial_uploads
+
+
+class FileReaper:
+    """Фоновое удаление файлов старше FILE_LIFETIME дней.
+
+    Истекшие File удаляются пачками по FILE_REAPER_BATCH_SIZE, каждая пачка - в своей
+    короткой транзакции. Файлы с диска удаляет пул из FILE_REAPER_WORKERS потоков уже после
+    фиксации. Удаление через DELETE ... RETURNING, поэтому ссылка на блоб снимается ровно
+    один раз, даже если очистка запущена в нескольких процессах.
+
+    В режиме dry-run ничего не удаляется, только подсчитывается.
+    """
+
+    def __init__(self):
+        self.interval = 3600
+        self.batch_size = 500
+        self.workers = 4
+        self.dry_run = False
+        self._socketio = None
+        self._started = False
+        self._last_run = None
+        self._totals = Counter()
+        self._lock = threading.Lock()
+
+    def configure(self, app, socketio):
+        with self._lock:
+            self.interval = app.config['FILE_REAPER_INTERVAL']
+            self.batch_size = app.config['FILE_REAPER_BATCH_SIZE']
+            self.workers = app.config['FILE_REAPER_WORKERS']
+            self.dry_run = app.config['FILE_REAPER_DRY_RUN']
+            self._socketio = socketio
+            self._started = False
+
+    def start(self, app):
+        """Периодическая очистка в цикле сервера; FILE_REAPER_INTERVAL=0 - только через CLI"""
+        with self._lock:
+            if self._started or not self.interval:
+                return
+            self._started = True
+        self._socketio.start_background_task(self._run, app)
+
+    def _run(self, app):
+        while True:
+            with app.app_context():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"❌ Ошибка очистки старых файлов: {str(e)}")
+            self._socketio.sleep(self.interval)
+
+    def run_once(self, dry_run=None):
+        dry_run = self.dry_run if dry_run is None else dry_run
+        started = time.perf_counter()
+        expiration = datetime.datetime.utcnow() - datetime.timedelta(days=current_app.config['FILE_LIFETIME'])
+        metrics = Counter({key: 0 for key in ('batches', 'files', 'blobs', 'removed_files', 'bytes', 'errors')})
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            last_id = 0
+            while True:
+                rows = db.session.query(File.id, File.filesize) \
+                    .filter(File.upload_date < expiration, File.id > last_id) \
+                    .order_by(File.id) \
+                    .limit(self.batch_size) \
+                    .all()
+                # Чтение тоже завершает транзакцию - не держим снимок между пачками
+                db.session.commit()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                metrics['batches'] += 1
+
+                if dry_run:
+                    metrics['files'] += len(rows)
+                    metrics['bytes'] += sum(row.filesize or 0 for row in rows)
+                    continue
+
+                paths = self._delete_batch([row.id for row in rows], expiration, metrics)
+                for freed in pool.map(self._remove, paths):
+                    self._count_removed(freed, metrics)
+
+            if not dry_run:
+                # Блобы без ссылок, отложенные прошлыми проходами из-за недавней загрузки
+                # и файлы без строки Blob, чья транзакция не дошла до commit
+                for sweep in (purge_blobs, sweep_orphan_files):
+                    blob_paths, derived_paths = sweep()
+                    metrics['blobs'] += len(blob_paths)
+                    for freed in pool.map(self._remove, blob_paths + derived_paths):
+                        self._count_removed(freed, metrics)
+
+        if not dry_run:
+            metrics['partial_uploads'] = cleanup_partial_uploads(current_app)
+
+        result = dict(metrics, dry_run=dry_run, elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+                      finished=datetime.datetime.utcnow().isoformat() + 'Z')
+        with self._lock:
+            self._last_run = result
+            if not dry_run:
+                self._totals.update(metrics)
+
+        mode = 'dry-run, ' if dry_run else ''
+        print(f"🧹 Очистка старых файлов ({mode}{result['elapsed_ms']} мс): записей {metrics['files']}, "
+              f"удалено с диска {metrics['removed_files']}, освобождено {metrics['bytes']} байт, "
+              f"ошибок {metrics['errors']}")
+        return result
+
+    def _delete_batch(self, ids, expiration, metrics):
+        """Удаляет пачку File одной транзакцией; возвращает пути, которые больше не нужны"""
+        deleted = db.session.execute(
+            delete(File)
+            .where(File.id.in_(ids), File.upload_date < expiration)
+            .returning(File.blob_hash, File.filename)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        references = Counter(row.blob_hash for row in deleted if row.blob_hash)
+        for blob_hash, count in references.items():
+            release(blob_hash, count)
+        db.session.commit()
+        metrics['files'] += len(deleted)
+
+        # Файлы, загруженные до хранилища по хешу, лежат под своим именем
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        paths = [os.path.join(upload_folder, row.filename) for row in deleted if not row.blob_hash]
+        blob_paths, derived_paths = purge_blobs(references)
+        metrics['blobs'] += len(blob_paths)
+        return paths + blob_paths + derived_paths
+
+    @staticmethod
+    def _count_removed(freed, metrics):
+        if freed is None:
+            metrics['errors'] += 1
+        else:
+            metrics['removed_files'] += 1
+            metrics['bytes'] += freed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            print(f"⚠️ Ошибка удаления файла {path}: {str(e)}")
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'dry_run': self.dry_run,
+                'last_run': dict(self._last_run) if self._last_run else None,
+                'total_files': self._totals['files'],
+                'total_bytes': self._totals['bytes']
+            }
+
+
+file_reaper = FileReaper()
+
+
+def init_file_reaper(app, socketio):
+    file_reaper.configure(app, socketio)
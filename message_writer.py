@@ -0,0 +1,205 @@
+# message_writer.py
+import time
+import queue
+import threading
+from flask import current_app
+from sqlalchemy import func, text
+from extensions import db
+from models import Conversation, Message
+from utils import get_chat_room_name, record_message, push_unread_counts, emit_messages_read
+
+
+class MessageWriter:
+    """Отложенная запись сообщений чата (write-behind).
+
+    Сообщение сразу получает id и рассылается, а в БД его записывает фоновый
+    писатель: сообщения, накопившиеся за MESSAGE_BATCH_WINDOW, сохраняются одной
+    транзакцией. Очередь ограничена MESSAGE_QUEUE_SIZE: если писатель не успевает,
+    отправитель ждет не дольше MESSAGE_QUEUE_TIMEOUT и получает ошибку.
+
+    Id выдаются последовательностью PostgreSQL по одному на сообщение - так они идут
+    в порядке отправки и между воркерами, на чем держится отметка о прочтении up_to_id.
+    Для SQLite id выдает счетчик процесса, поэтому с SQLite режим допустим только для
+    одного воркера. Сообщения, еще не
+    записанные к моменту остановки процесса, теряются.
+
+    Получатель может отметить сообщение прочитанным раньше, чем оно записано:
+    такие сообщения сохраняются прочитанными по Conversation.last_read_id.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.batch_size = 200
+        self.batch_window = 0.05
+        self.put_timeout = 2
+        self._socketio = None
+        self._queue = None
+        self._started = False
+        self._next_id = None
+        self._lock = threading.Lock()
+
+    def configure(self, app, socketio):
+        with self._lock:
+            self.enabled = app.config['MESSAGE_WRITE_BEHIND']
+            self.batch_size = app.config['MESSAGE_BATCH_SIZE']
+            self.batch_window = app.config['MESSAGE_BATCH_WINDOW']
+            self.put_timeout = app.config['MESSAGE_QUEUE_TIMEOUT']
+            self._socketio = socketio
+            # Очередь драйвера Socket.IO: ожидание в ней не блокирует eventlet
+            self._queue = socketio.server.eio.create_queue(maxsize=app.config['MESSAGE_QUEUE_SIZE'])
+            self._started = False
+            self._next_id = None
+
+    def allocate_id(self):
+        """Следующий id сообщения без вставки строки"""
+        if db.engine.dialect.name == 'postgresql':
+            # Без резервирования блоков: блоки разных воркеров нарушили бы порядок id
+            return db.session.execute(text(
+                "SELECT nextval(pg_get_serial_sequence('message', 'id'))"
+            )).scalar()
+
+        with self._lock:
+            if self._next_id is None:
+                self._next_id = (db.session.query(func.max(Message.id)).scalar() or 0) + 1
+            message_id = self._next_id
+            self._next_id += 1
+            return message_id
+
+    def assign_id(self, message):
+        """В режиме write-behind синхронные пути тоже берут id из общего источника"""
+        if self.enabled and message.id is None:
+            message.id = self.allocate_id()
+
+    def submit(self, message, sid=None, temp_id=None):
+        """Ставит сообщение в очередь записи; False, если очередь переполнена"""
+        self._start()
+        item = {
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'recipient_id': message.recipient_id,
+            'content': message.content,
+            'timestamp': message.timestamp,
+            'sid': sid,
+            'temp_id': temp_id
+        }
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _start(self):
+        app = current_app._get_current_object()
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._socketio.start_background_task(self._run, app)
+
+    def _run(self, app):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with app.app_context():
+                try:
+                    self._persist(batch)
+                except Exception as e:
+                    print(f"❌ Ошибка фоновой записи сообщений: {str(e)}")
+
+    def _add(self, item):
+        """Добавляет сообщение в транзакцию; True, если оно уже прочитано получателем"""
+        message = Message(
+            id=item['id'],
+            content=item['content'],
+            sender_id=item['sender_id'],
+            recipient_id=item['recipient_id'],
+            timestamp=item['timestamp'],
+            is_read=False
+        )
+        db.session.add(message)
+        # Запрос идет после autoflush вставки, а FOR UPDATE ждет незавершенный mark_read_up_to:
+        # отметка и UPDATE сообщений в нем не могут разминуться с этой записью
+        last_read_id = db.session.query(Conversation.last_read_id).filter_by(
+            user_id=item['recipient_id'], peer_id=item['sender_id']).with_for_update().scalar()
+        message.is_read = last_read_id is not None and item['id'] <= last_read_id
+        record_message(message)
+        return message.is_read
+
+    def _persist(self, batch):
+        started = time.perf_counter()
+        failed = []
+        try:
+            read = [item for item in batch if self._add(item)]
+            db.session.commit()
+            saved = batch
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ Групповая запись не удалась ({str(e)}), сохраняем по одному")
+            # Ошибка одного сообщения не должна терять остальные
+            saved = []
+            read = []
+            for item in batch:
+                try:
+                    is_read = self._add(item)
+                    db.session.commit()
+                    saved.append(item)
+                    if is_read:
+                        read.append(item)
+                except Exception as item_error:
+                    db.session.rollback()
+                    failed.append((item, item_error))
+
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"💾 Записано сообщений: {len(saved)} за {elapsed:.1f} мс, ошибок: {len(failed)}, "
+              f"в очереди: {self.pending()}")
+
+        socketio = self._socketio
+        for item in saved:
+            if item['sid']:
+                socketio.emit('message_delivered', {
+                    'temp_id': item['temp_id'],
+                    'message_id': item['id'],
+                    'timestamp': item['timestamp'].isoformat() + 'Z'
+                }, room=item['sid'])
+        if saved:
+            push_unread_counts(socketio, *{item['recipient_id'] for item in saved})
+
+        # Отметка о прочтении пришла раньше записи и ничего не обновила - подтверждаем сейчас
+        receipts = {}
+        for item in read:
+            key = (item['recipient_id'], item['sender_id'])
+            up_to_id, count = receipts.get(key, (0, 0))
+            receipts[key] = (max(up_to_id, item['id']), count + 1)
+        for (reader_id, peer_id), (up_to_id, count) in receipts.items():
+            emit_messages_read(socketio, reader_id, peer_id, up_to_id, count)
+
+        for item, error in failed:
+            print(f"❌ Сообщение {item['id']} не сохранено: {str(error)}")
+            if item['sid']:
+                socketio.emit('error', {
+                    'message': 'Не удалось сохранить сообщение',
+                    'temp_id': item['temp_id'],
+                    'message_id': item['id']
+                }, room=item['sid'])
+            # Сообщение уже разослано оптимистично - участники чата должны его убрать
+            socketio.emit('message_failed', {'message_id': item['id']},
+                          room=get_chat_room_name(item['sender_id'], item['recipient_id']))
+
+
+message_writer = MessageWriter()
+
+
+def init_message_writer(app, socketio):
+    message_writer.configure(app, socketio)
@@ -12,14 +12,13 @@ class User(db.Model):
     department = db.Column(db.String(120))
     position = db.Column(db.String(120))
     is_active = db.Column(db.Boolean, default=True)
+    is_admin = db.Column(db.Boolean, default=False)
     last_seen = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     password_hash = db.Column(db.String(128), default='')
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
 
     def unread_messages_count(self):
-        return Message.query.filter_by(
-            recipient_id=self.id,
-            is_read=False
-        ).count()
+        return self.unread_count or 0
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,6 +28,12 @@ class Post(db.Model):
     user = db.relationship('User', backref=db.backref('posts', lazy=True))
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_recipient_is_read', 'recipient_id', 'is_read'),
+        db.Index('ix_message_sender_recipient_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+        db.Index('ix_message_recipient_sender_timestamp', 'recipient_id', 'sender_id', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
@@ -39,14 +44,60 @@ class Message(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id], backref=db.backref('sent_messages', lazy=True))
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref=db.backref('received_messages', lazy=True))
 
+class Conversation(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'peer_id', name='uq_conversation_user_peer'),
+        db.Index('ix_conversation_user_last_timestamp', 'user_id', 'last_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_timestamp = db.Column(db.DateTime)
+    preview = db.Column(db.String(255), default='')
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    # До какого id user_id прочитал сообщения peer_id (mark_read с up_to_id)
+    last_read_id = db.Column(db.Integer)
+
+class Blob(db.Model):
+    """Содержимое файла, хранящееся один раз по SHA-256; refcount - число ссылающихся File"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def path(sha256):
+        # Двухуровневое разбиение по префиксу хеша, чтобы каталоги не разрастались
+        return os.path.join(current_app.config['BLOB_FOLDER'], sha256[:2], sha256[2:4], sha256)
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
-    upload_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    upload_date = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True, index=True)
     filesize = db.Column(db.BigInteger, default=0)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blob.sha256'), nullable=True, index=True)
 
     @property
     def filepath(self):
-        return os.path.join(current_app.config['UPLOAD_FOLDER'], self.filename)
\ No newline at end of file
+        if self.blob_hash:
+            return Blob.path(self.blob_hash)
+        # Файлы, загруженные до хранилища по хешу, лежат под своим именем
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], self.filename)
+
+class SyncState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    dc_host = db.Column(db.String(255))
+    highest_usn = db.Column(db.BigInteger)
+    last_sync = db.Column(db.DateTime)
+    last_full_sync = db.Column(db.DateTime)
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
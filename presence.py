@@ -0,0 +1,255 @@
+# presence.py
+import time
+import threading
+
+
+class MemoryPresenceStore:
+    """Присутствие в памяти процесса: несколько сессий (вкладок) на пользователя с TTL"""
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, user_id, now):
+        sessions = self._sessions.get(user_id)
+        if sessions is None:
+            return
+        for sid in [sid for sid, info in sessions.items() if info['expires_at'] <= now]:
+            del sessions[sid]
+        if not sessions:
+            del self._sessions[user_id]
+
+    def connect(self, user_id, sid):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(user_id, now)
+            sessions = self._sessions.setdefault(user_id, {})
+            first = not sessions
+            sessions[sid] = {'room': None, 'expires_at': now + self.ttl}
+            return first
+
+    def disconnect(self, user_id, sid):
+        now = time.monotonic()
+        with self._lock:
+            sessions = self._sessions.get(user_id)
+            if not sessions:
+                return False
+            sessions.pop(sid, None)
+            self._purge(user_id, now)
+            return user_id not in self._sessions
+
+    # heartbeat и set_room живой сессии возвращают пользователя, которого expire() уже
+    # объявил офлайн: True, как у connect, чтобы об этом узнали остальные
+    def heartbeat(self, user_id, sid):
+        now = time.monotonic()
+        with self._lock:
+            returned = user_id not in self._sessions
+            sessions = self._sessions.setdefault(user_id, {})
+            info = sessions.setdefault(sid, {'room': None, 'expires_at': now})
+            info['expires_at'] = now + self.ttl
+            return returned
+
+    def set_room(self, user_id, sid, room):
+        now = time.monotonic()
+        with self._lock:
+            returned = user_id not in self._sessions
+            sessions = self._sessions.setdefault(user_id, {})
+            info = sessions.setdefault(sid, {'room': None, 'expires_at': now + self.ttl})
+            info['room'] = room
+            return returned
+
+    def _live(self, user_id, now):
+        return [info for info in self._sessions.get(user_id, {}).values() if info['expires_at'] > now]
+
+    # Чтение не удаляет просроченные сессии: это делает expire(), чтобы уход в офлайн не потерялся
+    def rooms(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            return {info['room'] for info in self._live(user_id, now) if info['room']}
+
+    def is_online(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            return bool(self._live(user_id, now))
+
+    def online_ids(self):
+        now = time.monotonic()
+        with self._lock:
+            return {user_id for user_id in self._sessions if self._live(user_id, now)}
+
+    def expire(self):
+        """Удаляет просроченные сессии, возвращает пользователей, ушедших в офлайн"""
+        now = time.monotonic()
+        with self._lock:
+            before = set(self._sessions)
+            for user_id in list(self._sessions):
+                self._purge(user_id, now)
+            return before - set(self._sessions)
+
+
+class RedisPresenceStore:
+    """Присутствие в Redis (или совместимом сервере), общее для всех воркеров.
+
+    presence:users         - ZSET user_id -> время истечения последней живой сессии
+    presence:user:<id>     - ZSET sid -> время истечения сессии
+    presence:rooms:<id>    - HASH sid -> комната чата
+    """
+
+    def __init__(self, client, ttl=90, prefix='presence'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, ttl=90):
+        import redis
+        return cls(redis.Redis.from_url(url, decode_responses=True), ttl=ttl)
+
+    def _users_key(self):
+        return f"{self.prefix}:users"
+
+    def _sessions_key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    def _rooms_key(self, user_id):
+        return f"{self.prefix}:rooms:{user_id}"
+
+    def _touch(self, pipe, user_id, sid, now):
+        expires_at = now + self.ttl
+        pipe.zadd(self._sessions_key(user_id), {sid: expires_at})
+        pipe.zremrangebyscore(self._sessions_key(user_id), '-inf', now)
+        pipe.expire(self._sessions_key(user_id), self.ttl * 2)
+        pipe.expire(self._rooms_key(user_id), self.ttl * 2)
+        pipe.zadd(self._users_key(), {str(user_id): expires_at})
+
+    def connect(self, user_id, sid):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(self._sessions_key(user_id), '-inf', now)
+        pipe.zcard(self._sessions_key(user_id))
+        self._touch(pipe, user_id, sid, now)
+        pipe.hdel(self._rooms_key(user_id), sid)
+        results = pipe.execute()
+        return int(results[1]) == 0
+
+    def disconnect(self, user_id, sid):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zrem(self._sessions_key(user_id), sid)
+        pipe.hdel(self._rooms_key(user_id), sid)
+        pipe.zremrangebyscore(self._sessions_key(user_id), '-inf', now)
+        pipe.zcard(self._sessions_key(user_id))
+        results = pipe.execute()
+        if int(results[3]) > 0:
+            return False
+        return self._drop_user(user_id)
+
+    def _drop_user(self, user_id):
+        pipe = self.client.pipeline()
+        pipe.zrem(self._users_key(), str(user_id))
+        pipe.delete(self._sessions_key(user_id), self._rooms_key(user_id))
+        removed = pipe.execute()[0]
+        return int(removed) > 0
+
+    def heartbeat(self, user_id, sid):
+        pipe = self.client.pipeline()
+        # Пользователя нет в presence:users - expire() или disconnect уже объявили его офлайн
+        pipe.zscore(self._users_key(), str(user_id))
+        self._touch(pipe, user_id, sid, time.time())
+        return pipe.execute()[0] is None
+
+    def set_room(self, user_id, sid, room):
+        pipe = self.client.pipeline()
+        pipe.zscore(self._users_key(), str(user_id))
+        if room:
+            pipe.hset(self._rooms_key(user_id), sid, room)
+        else:
+            pipe.hdel(self._rooms_key(user_id), sid)
+        if pipe.execute()[0] is not None:
+            return False
+        # Сессия пережила очистку присутствия - регистрируем ее заново
+        return self.heartbeat(user_id, sid)
+
+    def rooms(self, user_id):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zrangebyscore(self._sessions_key(user_id), now, '+inf')
+        pipe.hgetall(self._rooms_key(user_id))
+        live_sids, rooms = pipe.execute()
+        live_sids = set(live_sids)
+        return {room for sid, room in rooms.items() if sid in live_sids and room}
+
+    def is_online(self, user_id):
+        score = self.client.zscore(self._users_key(), str(user_id))
+        return score is not None and float(score) > time.time()
+
+    def online_ids(self):
+        return {int(user_id) for user_id in self.client.zrangebyscore(self._users_key(), time.time(), '+inf')}
+
+    def expire(self):
+        now = time.time()
+        offline = set()
+        for user_id in self.client.zrangebyscore(self._users_key(), '-inf', now):
+            pipe = self.client.pipeline()
+            pipe.zremrangebyscore(self._sessions_key(user_id), '-inf', now)
+            pipe.zrange(self._sessions_key(user_id), 0, -1, withscores=True)
+            _, sessions = pipe.execute()
+            if sessions:
+                # Сессии другого воркера еще живы - переносим срок пользователя
+                self.client.zadd(self._users_key(), {str(user_id): max(score for _, score in sessions)})
+            elif self._drop_user(user_id):
+                offline.add(int(user_id))
+        return offline
+
+
+class PresenceRegistry:
+    """Точка доступа к хранилищу присутствия, выбираемому конфигурацией"""
+
+    def __init__(self):
+        self.store = MemoryPresenceStore()
+
+    def configure(self, app, client=None):
+        ttl = app.config['PRESENCE_TTL']
+        if app.config['PRESENCE_BACKEND'] == 'redis':
+            if client is not None:
+                self.store = RedisPresenceStore(client, ttl=ttl)
+            else:
+                self.store = RedisPresenceStore.from_url(app.config['PRESENCE_REDIS_URL'], ttl=ttl)
+        else:
+            self.store = MemoryPresenceStore(ttl=ttl)
+
+    def connect(self, user_id, sid):
+        """Регистрирует сессию; True, если это первая сессия пользователя (стал онлайн)"""
+        return self.store.connect(int(user_id), sid)
+
+    def disconnect(self, user_id, sid):
+        """Удаляет сессию; True, если это была последняя сессия (стал офлайн)"""
+        return self.store.disconnect(int(user_id), sid)
+
+    def heartbeat(self, user_id, sid):
+        """Продлевает сессию; True, если пользователь снова стал онлайн после expire()"""
+        return self.store.heartbeat(int(user_id), sid)
+
+    def set_room(self, user_id, sid, room):
+        """Запоминает комнату сессии; True, если пользователь снова стал онлайн после expire()"""
+        return self.store.set_room(int(user_id), sid, room)
+
+    def in_room(self, user_id, room):
+        return room in self.store.rooms(int(user_id))
+
+    def is_online(self, user_id):
+        return self.store.is_online(int(user_id))
+
+    def online_ids(self):
+        return self.store.online_ids()
+
+    def expire(self):
+        return self.store.expire()
+
+
+presence = PresenceRegistry()
+
+
+def init_presence(app, client=None):
+    presence.configure(app, client)
@@ -1,11 +1,39 @@
 import datetime
+import mimetypes
 import os
+import time
+import click
 from werkzeug.utils import secure_filename
-from flask import render_template, request, redirect, url_for, send_from_directory, session, jsonify, abort, current_app
-from extensions import auth, db
+from flask import render_template, request, redirect, url_for, send_file, session, jsonify, abort, current_app
+from sqlalchemy.orm import joinedload, selectinload
+from extensions import auth, db, pool_stats
 from models import User, Post, Message, File
-from utils import get_chat_room_name, active_users, filesizeformat_filter
-from auth import sync_ad_users
+from utils import (get_chat_room_name, get_conversations, record_message, record_read,
+                   rebuild_conversations, get_current_user, get_unread_total, encode_cursor, decode_cursor, keyset_before, keyset_after,
+                   push_unread_counts, mark_read_up_to, emit_messages_read, build_message_payload, dispatch_message,
+                   filesizeformat_filter)
+from auth import sync_ad_users, verification_cache
+from presence import presence
+from message_writer import message_writer
+from file_reaper import file_reaper
+from thumbnails import thumbnails
+from search import search_messages, decode_search_cursor, rebuild_search_index
+from blobstore import acquire, store_stream
+from uploads import UploadError, create_upload, get_upload, write_chunk, finalize_upload, discard_upload
+
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+# Кэш отрисованной первой страницы ленты (в пределах процесса)
+_feed_cache = {'html': None, 'next_cursor': None, 'expires_at': 0}
+
+
+def invalidate_feed_cache():
+    _feed_cache.update(html=None, next_cursor=None, expires_at=0)
 
 
 def init_routes(app, socketio):
@@ -17,19 +45,66 @@ def init_routes(app, socketio):
         }
 
         if 'user_id' in session:
-            user = User.query.get(session['user_id'])
-            common['current_user'] = user
-            common['unread_messages_count'] = user.unread_messages_count() if user else 0
+            common['current_user'] = get_current_user()
+            common['unread_messages_count'] = get_unread_total()
 
         return common
 
     app.template_filter('filesizeformat')(filesizeformat_filter)
 
+    def get_feed_page(cursor=None, limit=FEED_PAGE_SIZE):
+        query = Post.query.options(joinedload(Post.user))
+        if cursor:
+            query = query.filter(keyset_before(Post.timestamp, Post.id, cursor))
+        posts = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = encode_cursor(posts[-1].timestamp, posts[-1].id)
+        return posts, next_cursor
+
+    def render_first_feed_page():
+        ttl = current_app.config['FEED_CACHE_TTL']
+        if ttl > 0 and _feed_cache['html'] is not None and _feed_cache['expires_at'] > time.monotonic():
+            return _feed_cache['html'], _feed_cache['next_cursor']
+
+        posts, next_cursor = get_feed_page()
+        posts_html = render_template('feed_posts.html', posts=posts)
+        if ttl > 0:
+            _feed_cache.update(html=posts_html, next_cursor=next_cursor,
+                               expires_at=time.monotonic() + ttl)
+        return posts_html, next_cursor
+
     @app.route('/')
     @auth.login_required
     def index():
-        posts = Post.query.order_by(Post.timestamp.desc()).all()
-        return render_template('index.html', posts=posts)
+        posts_html, next_cursor = render_first_feed_page()
+        return render_template('index.html', posts_html=posts_html.strip(), next_cursor=next_cursor)
+
+    @app.route('/feed')
+    @auth.login_required
+    def feed():
+        limit = min(max(request.args.get('limit', FEED_PAGE_SIZE, type=int), 1), FEED_MAX_PAGE_SIZE)
+        before = request.args.get('before')
+        try:
+            cursor = decode_cursor(before) if before else None
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        posts, next_cursor = get_feed_page(cursor, limit)
+        return jsonify({
+            'posts': [{
+                'id': post.id,
+                'content': post.content,
+                'timestamp': post.timestamp.isoformat() + 'Z',
+                'user_id': post.user_id,
+                'user_fullname': post.user.fullname
+            } for post in posts],
+            'html': render_template('feed_posts.html', posts=posts),
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        })
 
     @app.route('/post', methods=['POST'])
     @auth.login_required
@@ -39,13 +114,14 @@ def init_routes(app, socketio):
             post = Post(content=content, user_id=session['user_id'])
             db.session.add(post)
             db.session.commit()
+            invalidate_feed_cache()
         return redirect(url_for('index'))
 
     @app.route('/users')
     @auth.login_required
     def users():
-        online_user_ids = list(active_users.keys())
-        current_user = User.query.get(session['user_id'])
+        online_user_ids = presence.online_ids()
+        current_user = get_current_user()
         current_department = current_user.department if current_user else None
         users = User.query.filter_by(is_active=True).all()
 
@@ -81,14 +157,14 @@ def init_routes(app, socketio):
         return render_template('users.html',
                                users=sorted_users,
                                departments=departments,
-                               online_user_ids=online_user_ids,
+                               online_user_ids=list(online_user_ids),
                                current_user=current_user)
 
     @app.route('/profile/<username>')
     @auth.login_required
     def user_profile(username):
         user = User.query.filter_by(username=username, is_active=True).first_or_404()
-        online_user_ids = list(active_users.keys())
+        online_user_ids = list(presence.online_ids())
         return render_template(
             'profile.html',
             profile_user=user,
@@ -99,53 +175,16 @@ def init_routes(app, socketio):
     @auth.login_required
     def chat(user_id):
         current_user_id = session['user_id']
-        current_user = User.query.get(current_user_id)
+        current_user = get_current_user()
         recipient = User.query.get_or_404(user_id)
 
-        sent_to = db.session.query(
-            Message.recipient_id
-        ).filter(
-            Message.sender_id == current_user_id
-        ).distinct()
-
-        received_from = db.session.query(
-            Message.sender_id
-        ).filter(
-            Message.recipient_id == current_user_id
-        ).distinct()
-
-        all_user_ids = {id for (id,) in sent_to} | {id for (id,) in received_from}
-
-        conversations = []
-        unread_counts = {}
-
-        for user_id in all_user_ids:
-            last_message = Message.query.filter(
-                ((Message.sender_id == current_user_id) & (Message.recipient_id == user_id)) |
-                ((Message.sender_id == user_id) & (Message.recipient_id == current_user_id))
-            ).order_by(Message.timestamp.desc()).first()
-
-            if last_message:
-                user = User.query.get(user_id)
-                conversations.append((last_message, user))
-                count = Message.query.filter_by(
-                    sender_id=user_id,
-                    recipient_id=current_user_id,
-                    is_read=False
-                ).count()
-                unread_counts[user_id] = count
-
-        conversations.sort(key=lambda x: x[0].timestamp, reverse=True)
-
-        unread_messages = Message.query.filter_by(
-            sender_id=user_id,
-            recipient_id=current_user_id,
-            is_read=False
-        ).all()
-
-        for msg in unread_messages:
-            msg.is_read = True
+        read_count = mark_read_up_to(current_user_id, user_id)
         db.session.commit()
+        if read_count:
+            emit_messages_read(socketio, current_user_id, user_id, None, read_count)
+
+        # Список диалогов читаем после commit, чтобы не перезагружать объекты по одному
+        conversations, unread_counts = get_conversations(current_user_id)
 
         return render_template(
             'chat.html',
@@ -171,10 +210,42 @@ def init_routes(app, socketio):
     @app.route('/chat/history/<int:recipient_id>', methods=['GET'])
     @auth.login_required
     def chat_history(recipient_id):
-        messages = Message.query.filter(
-            ((Message.sender_id == session['user_id']) & (Message.recipient_id == recipient_id)) |
-            ((Message.sender_id == recipient_id) & (Message.recipient_id == session['user_id']))
-        ).order_by(Message.timestamp.desc()).limit(100).all()
+        current_user_id = session['user_id']
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        before = request.args.get('before')
+        after = request.args.get('after')
+
+        try:
+            cursor = decode_cursor(after or before) if (after or before) else None
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        query = Message.query.options(
+            joinedload(Message.sender),
+            selectinload(Message.files)
+        ).filter(
+            ((Message.sender_id == current_user_id) & (Message.recipient_id == recipient_id)) |
+            ((Message.sender_id == recipient_id) & (Message.recipient_id == current_user_id))
+        )
+
+        if after:
+            query = query.filter(keyset_after(Message.timestamp, Message.id, cursor))
+            query = query.order_by(Message.timestamp.asc(), Message.id.asc())
+        else:
+            if cursor:
+                query = query.filter(keyset_before(Message.timestamp, Message.id, cursor))
+            query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+        messages = query.limit(limit + 1).all()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+
+        next_cursor = None
+        if has_more and messages:
+            next_cursor = encode_cursor(messages[-1].timestamp, messages[-1].id)
+
+        if not after:
+            messages.reverse()
 
         result = []
         for msg in messages:
@@ -183,55 +254,79 @@ def init_routes(app, socketio):
                 'content': msg.content,
                 'timestamp': msg.timestamp.isoformat() + 'Z',
                 'sender_id': msg.sender_id,
+                'recipient_id': msg.recipient_id,
                 'sender_name': msg.sender.fullname,
                 'is_read': msg.is_read,
                 'files': [{
                     'id': f.id,
                     'filename': f.filename,
-                    'filesize': f.filesize
+                    'filesize': f.filesize,
+                    **thumbnails.preview_urls(f)
                 } for f in msg.files]
             }
             result.append(message_data)
 
-        return jsonify(result[::-1])
+        return jsonify({
+            'messages': result,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        })
 
-    @app.route('/inbox')
+    @app.route('/search')
     @auth.login_required
-    def inbox():
-        sent_to = db.session.query(
-            Message.recipient_id
-        ).filter(
-            Message.sender_id == session['user_id']
-        ).distinct()
-
-        received_from = db.session.query(
-            Message.sender_id
-        ).filter(
-            Message.recipient_id == session['user_id']
-        ).distinct()
+    def search():
+        current_user_id = session['user_id']
+        query = request.args.get('q', '').strip()
+        peer_id = request.args.get('peer_id', type=int)
+        limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        try:
+            cursor = decode_search_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
-        all_user_ids = {id for (id,) in sent_to} | {id for (id,) in received_from}
+        rows, next_cursor = search_messages(current_user_id, query, peer_id=peer_id, cursor=cursor, limit=limit)
 
-        conversations = []
-        unread_counts = {}
+        messages = Message.query.options(
+            joinedload(Message.sender),
+            joinedload(Message.recipient),
+            selectinload(Message.files)
+        ).filter(Message.id.in_([row.id for row in rows])).all()
+        by_id = {msg.id: msg for msg in messages}
 
-        for user_id in all_user_ids:
-            last_message = Message.query.filter(
-                ((Message.sender_id == session['user_id']) & (Message.recipient_id == user_id)) |
-                ((Message.sender_id == user_id) & (Message.recipient_id == session['user_id']))
-            ).order_by(Message.timestamp.desc()).first()
+        result = []
+        for row in rows:
+            msg = by_id.get(row.id)
+            if msg is None:
+                continue
+            peer = msg.recipient if msg.sender_id == current_user_id else msg.sender
+            result.append({
+                'id': msg.id,
+                'content': msg.content,
+                'timestamp': msg.timestamp.isoformat() + 'Z',
+                'sender_id': msg.sender_id,
+                'recipient_id': msg.recipient_id,
+                'sender_name': msg.sender.fullname,
+                'peer_id': peer.id,
+                'peer_name': peer.fullname,
+                'score': row.score,
+                'files': [{
+                    'id': f.id,
+                    'filename': f.filename,
+                    'filesize': f.filesize,
+                    **thumbnails.preview_urls(f)
+                } for f in msg.files]
+            })
 
-            if last_message:
-                user = User.query.get(user_id)
-                conversations.append((last_message, user))
-                count = Message.query.filter_by(
-                    sender_id=user_id,
-                    recipient_id=session['user_id'],
-                    is_read=False
-                ).count()
-                unread_counts[user_id] = count
+        return jsonify({
+            'results': result,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        })
 
-        conversations.sort(key=lambda x: x[0].timestamp, reverse=True)
+    @app.route('/inbox')
+    @auth.login_required
+    def inbox():
+        conversations, unread_counts = get_conversations(session['user_id'])
 
         return render_template('inbox.html', conversations=conversations, unread_counts=unread_counts)
 
@@ -246,16 +341,19 @@ def init_routes(app, socketio):
             return jsonify({'error': 'No selected file'}), 400
 
         filename = secure_filename(file.filename)
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        filesize = os.path.getsize(filepath)
+        blob_hash, filesize = store_stream(file.stream)
 
+        return jsonify(send_file_message(recipient_id, filename, filesize, blob_hash))
+
+    def send_file_message(recipient_id, filename, filesize, blob_hash):
+        """Создает сообщение с файлом, уже сохраненным в хранилище, и рассылает его"""
         message = Message(
             content=f"Отправлен файл: {filename}",
             sender_id=session['user_id'],
             recipient_id=recipient_id,
             is_read=False
         )
+        message_writer.assign_id(message)
         db.session.add(message)
         db.session.flush()
 
@@ -263,99 +361,205 @@ def init_routes(app, socketio):
             filename=filename,
             user_id=session['user_id'],
             message_id=message.id,
-            filesize=filesize
+            filesize=filesize,
+            blob_hash=blob_hash
         )
         db.session.add(new_file)
+        acquire(blob_hash, filesize)
+        record_message(message, [filename])
+        db.session.flush()
+        payload = build_message_payload(message, [new_file])
+        # Миниатюры строятся из блоба, уже лежащего на диске, - до commit, пока атрибуты не сброшены
+        thumbnails.submit(new_file)
         db.session.commit()
 
-        room = get_chat_room_name(session['user_id'], recipient_id)
-        sender = User.query.get(session['user_id'])
-
-        file_data = {
-            'id': message.id,
-            'sender_id': session['user_id'],
-            'recipient_id': recipient_id,
-            'sender_name': sender.fullname,
-            'content': f"Отправлен файл: {filename}",
-            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
-            'room': room,
-            'is_read': False,
-            'files': [{
-                'id': new_file.id,
-                'filename': filename,
-                'filesize': filesize
-            }]
+        dispatch_message(socketio, payload)
+
+        return {
+            'success': True,
+            'message_id': payload['id'],
+            'file_id': payload['files'][0]['id']
         }
 
-        socketio.emit('new_message', file_data, room=room)
+    # Загрузка по частям: POST /uploads -> PUT /uploads/<id>?offset=N -> POST /uploads/<id>/finalize.
+    # Части пишутся прямо на диск; прерванную загрузку можно продолжить с offset из GET /uploads/<id>.
+    def upload_error_response(error):
+        body = {'error': error.message}
+        if error.offset is not None:
+            body['offset'] = error.offset
+        return jsonify(body), error.status
 
-        recipient_info = active_users.get(recipient_id)
-        is_recipient_online = recipient_info and recipient_info.get('room') == room
+    @app.route('/uploads', methods=['POST'])
+    @auth.login_required
+    def init_upload():
+        data = request.get_json(silent=True) or {}
+        try:
+            recipient_id = int(data['recipient_id'])
+            size = int(data['size'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Требуются recipient_id и size'}), 400
+        if not User.query.filter_by(id=recipient_id, is_active=True).first():
+            return jsonify({'error': 'Получатель не найден'}), 404
 
-        if is_recipient_online:
-            socketio.emit('new_message_notification', {
-                'sender_id': session['user_id'],
-                'sender_name': sender.fullname,
-                'content': f"Отправлен файл: {filename}",
-                'room': room,
-                'recipient_id': recipient_id,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }, room=f"user_{recipient_id}")
-        else:
-            print(f"🔕 Пользователь {recipient_id} не в текущем чате или не онлайн")
-
-        socketio.emit('inbox_update', {
-            'user_id': session['user_id'],
-            'recipient_id': recipient_id,
-            'content': f"Отправлен файл: {filename}",
-            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-        }, room=f"user_{session['user_id']}")
-
-        if recipient_id in active_users:
-            socketio.emit('inbox_update', {
-                'user_id': recipient_id,
-                'sender_id': session['user_id'],
-                'content': f"Отправлен файл: {filename}",
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }, room=f"user_{recipient_id}")
+        try:
+            upload = create_upload(session['user_id'], recipient_id, data.get('filename'), size)
+        except UploadError as e:
+            return upload_error_response(e)
+        return jsonify({
+            'upload_id': upload['upload_id'],
+            'offset': upload['offset'],
+            'size': upload['size'],
+            'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']
+        }), 201
 
+    @app.route('/uploads/<upload_id>', methods=['GET'])
+    @auth.login_required
+    def upload_status(upload_id):
+        try:
+            upload = get_upload(upload_id, session['user_id'])
+        except UploadError as e:
+            return upload_error_response(e)
         return jsonify({
-            'success': True,
-            'message_id': message.id,
-            'file_id': new_file.id
+            'upload_id': upload_id,
+            'filename': upload['filename'],
+            'offset': upload['offset'],
+            'size': upload['size'],
+            'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']
         })
 
-    @app.route('/download/<int:file_id>')
+    @app.route('/uploads/<upload_id>', methods=['PUT'])
     @auth.login_required
-    def download_file(file_id):
+    def upload_chunk(upload_id):
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Требуется offset'}), 400
         try:
-            file = File.query.get_or_404(file_id)
-            message = file.message
-
-            allowed = False
+            new_offset = write_chunk(upload_id, session['user_id'], offset, request.stream)
+        except UploadError as e:
+            return upload_error_response(e)
+        return jsonify({'upload_id': upload_id, 'offset': new_offset})
 
-            if file.user_id == session['user_id']:
-                allowed = True
-            elif message and message.recipient_id == session['user_id']:
-                allowed = True
-            elif session.get('is_admin'):
-                allowed = True
+    @app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+    @auth.login_required
+    def finalize_chunked_upload(upload_id):
+        try:
+            with finalize_upload(upload_id, session['user_id']) as upload:
+                result = send_file_message(upload['recipient_id'], upload['filename'], upload['size'],
+                                           upload['sha256'])
+        except UploadError as e:
+            return upload_error_response(e)
+        return jsonify(result)
+
+    @app.route('/uploads/<upload_id>', methods=['DELETE'])
+    @auth.login_required
+    def abort_upload(upload_id):
+        try:
+            discard_upload(upload_id, session['user_id'])
+        except UploadError as e:
+            return upload_error_response(e)
+        return jsonify({'success': True})
+
+    def accel_redirect_response(file, file_path):
+        """Отдача файла фронт-прокси (nginx X-Accel-Redirect); Range и 304 обрабатывает nginx"""
+        relative_path = os.path.relpath(file_path, current_app.config['UPLOAD_FOLDER'])
+        if relative_path.startswith(os.pardir):
+            return None
+        response = current_app.response_class()
+        response.headers['X-Accel-Redirect'] = (current_app.config['DOWNLOAD_ACCEL_REDIRECT'].rstrip('/') + '/'
+                                                + relative_path.replace(os.sep, '/'))
+        response.headers.set('Content-Disposition', 'attachment', filename=file.filename)
+        response.content_type = mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
+        if file.blob_hash:
+            response.set_etag(file.blob_hash)
+        response.cache_control.private = True
+        return response
+
+    def authorized_file(file_id):
+        """Файл, если текущий пользователь может его получить; иначе (None, ответ с ошибкой)"""
+        # Файл и получатель сообщения одним запросом - решение о доступе без ленивых загрузок
+        row = db.session.query(File, Message.recipient_id) \
+            .outerjoin(Message, File.message_id == Message.id) \
+            .filter(File.id == file_id) \
+            .first()
+        if row is None:
+            return None, ("File not found", 404)
+        file, recipient_id = row
+
+        allowed = False
+
+        if file.user_id == session['user_id']:
+            allowed = True
+        elif recipient_id == session['user_id']:
+            allowed = True
+        elif session.get('is_admin'):
+            allowed = True
+
+        if not allowed:
+            return None, ("Forbidden", 403)
+        return file, None
 
-            if not allowed:
-                return "Forbidden", 403
+    @app.route('/download/<int:file_id>')
+    @auth.login_required
+    def download_file(file_id):
+        try:
+            file, error = authorized_file(file_id)
+            if error:
+                return error
 
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], file.filename)
+            file_path = file.filepath
 
-            if not os.path.exists(file_path):
-                return "File not found", 404
+            if current_app.config['DOWNLOAD_ACCEL_REDIRECT']:
+                response = accel_redirect_response(file, file_path)
+                if response is not None:
+                    return response
 
-            return send_from_directory(
-                current_app.config['UPLOAD_FOLDER'],
-                file.filename,
+            # conditional: Range и If-None-Match/If-Range; содержимое блоба неизменно, его хеш - строгий ETag.
+            # При USE_X_SENDFILE Flask сам отдает заголовок X-Sendfile вместо тела.
+            response = send_file(
+                file_path,
                 as_attachment=True,
-                download_name=file.filename
+                download_name=file.filename,
+                conditional=True,
+                etag=file.blob_hash or True
             )
+            response.cache_control.private = True
+            return response
+        except FileNotFoundError:
+            return "File not found", 404
         except Exception as e:
+            print(f"❌ Ошибка отдачи файла {file_id}: {str(e)}")
+            return "Internal server error", 500
+
+    @app.route('/thumbnail/<int:file_id>/<size>')
+    @auth.login_required
+    def thumbnail(file_id, size):
+        try:
+            file, error = authorized_file(file_id)
+            if error:
+                return error
+            if size not in thumbnails.sizes or not thumbnails.supports(file):
+                return "Thumbnail not found", 404
+
+            thumbnail_path = thumbnails.wait_for(file, size)
+            if thumbnail_path is None:
+                return "Thumbnail not ready", 503, {'Retry-After': '2'}
+
+            # Миниатюра производна от неизменного блоба - кэшируется браузером без перепроверки
+            response = send_file(
+                thumbnail_path,
+                mimetype='image/jpeg',
+                conditional=True,
+                etag=f"{file.blob_hash}-{thumbnails.sizes[size]}",
+                max_age=365 * 24 * 3600
+            )
+            response.cache_control.public = False
+            response.cache_control.private = True
+            response.cache_control.immutable = True
+            return response
+        except FileNotFoundError:
+            return "Thumbnail not found", 404
+        except Exception as e:
+            print(f"❌ Ошибка отдачи миниатюры {file_id}: {str(e)}")
             return "Internal server error", 500
 
     @app.route('/mark_as_read/<int:message_id>', methods=['POST'])
@@ -366,8 +570,11 @@ def init_routes(app, socketio):
             current_user_id = session['user_id']
 
             if message.recipient_id == current_user_id:
-                message.is_read = True
+                if not message.is_read:
+                    message.is_read = True
+                    record_read(current_user_id, message.sender_id, 1)
                 db.session.commit()
+                push_unread_counts(socketio, current_user_id)
 
                 room = get_chat_room_name(message.sender_id, message.recipient_id)
                 socketio.emit('message_read', {
@@ -407,41 +614,48 @@ def init_routes(app, socketio):
             'total_files': File.query.count(),
             'total_messages': Message.query.count()
         }
-        return render_template('admin.html', users=users, stats=stats)
+        return render_template('admin.html', users=users, stats=stats,
+                               auth_cache=verification_cache.stats(), db_pool=pool_stats.stats(),
+                               file_reaper=file_reaper.stats())
 
     @app.route('/unread_count')
     @auth.login_required
     def unread_count():
-        count = Message.query.filter_by(
-            recipient_id=session['user_id'],
-            is_read=False
-        ).count()
-        return jsonify({'count': count})
+        return jsonify({'count': get_unread_total()})
 
     @app.route('/mark_all_as_read/<int:sender_id>', methods=['POST'])
     @auth.login_required
     def mark_all_as_read(sender_id):
         try:
             current_user_id = session['user_id']
-            messages = Message.query.filter_by(
-                sender_id=sender_id,
-                recipient_id=current_user_id,
-                is_read=False
-            ).all()
+            read_count = mark_read_up_to(current_user_id, sender_id)
+            db.session.commit()
+            emit_messages_read(socketio, current_user_id, sender_id, None, read_count)
 
-            for msg in messages:
-                msg.is_read = True
+            return jsonify({'status': 'success', 'count': read_count})
 
-            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'status': 'error'}), 500
 
-            socketio.emit('inbox_update', {
-                'user_id': current_user_id,
-                'sender_id': sender_id,
-                'is_read_update': True
-            }, room=f"user_{current_user_id}")
+    @app.route('/mark_read_up_to/<int:sender_id>', methods=['POST'])
+    @auth.login_required
+    def mark_read_up_to_route(sender_id):
+        try:
+            data = request.get_json(silent=True) or request.form
+            up_to_id = data.get('up_to_id')
+            up_to_id = int(up_to_id) if up_to_id is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Invalid up_to_id'}), 400
 
-            return jsonify({'status': 'success'})
+        try:
+            current_user_id = session['user_id']
+            read_count = mark_read_up_to(current_user_id, sender_id, up_to_id)
+            db.session.commit()
+            if read_count:
+                emit_messages_read(socketio, current_user_id, sender_id, up_to_id, read_count)
 
+            return jsonify({'status': 'success', 'count': read_count, 'up_to_id': up_to_id})
         except Exception as e:
             db.session.rollback()
             return jsonify({'status': 'error'}), 500
@@ -463,54 +677,18 @@ def init_routes(app, socketio):
                 recipient_id=recipient_id,
                 is_read=False
             )
+            message_writer.assign_id(message)
             db.session.add(message)
+            db.session.flush()
+            record_message(message)
+            payload = build_message_payload(message)
             db.session.commit()
 
-            room = get_chat_room_name(session['user_id'], recipient_id)
-            sender = User.query.get(session['user_id'])
-
-            message_data = {
-                'id': message.id,
-                'sender_id': session['user_id'],
-                'recipient_id': recipient_id,
-                'sender_name': sender.fullname,
-                'content': content,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
-                'room': room,
-                'is_read': False,
-                'files': []
-            }
-
-            socketio.emit('new_message', message_data, room=room)
-
-            if recipient_id in active_users:
-                socketio.emit('new_message_notification', {
-                    'sender_id': session['user_id'],
-                    'sender_name': sender.fullname,
-                    'content': content,
-                    'room': room,
-                    'recipient_id': recipient_id,
-                    'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-                }, room=f"user_{recipient_id}")
-
-            socketio.emit('inbox_update', {
-                'user_id': session['user_id'],
-                'recipient_id': recipient_id,
-                'content': content,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }, room=f"user_{session['user_id']}")
-
-            if recipient_id in active_users:
-                socketio.emit('inbox_update', {
-                    'user_id': recipient_id,
-                    'sender_id': session['user_id'],
-                    'content': content,
-                    'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-                }, room=f"user_{recipient_id}")
+            dispatch_message(socketio, payload)
 
             return jsonify({
                 'status': 'success',
-                'message_id': message.id
+                'message_id': payload['id']
             })
 
         except Exception as e:
@@ -518,6 +696,22 @@ def init_routes(app, socketio):
             return jsonify({'status': 'error', 'message': str(e)}), 500
 
     @app.cli.command('sync-ad')
-    def sync_ad_users_command():
-        sync_ad_users()
-        print("Синхронизация завершена")
\ No newline at end of file
+    @click.option('--full/--incremental', default=None,
+                  help='Принудительно полная или инкрементальная синхронизация')
+    def sync_ad_users_command(full):
+        sync_ad_users(full=full)
+        print("Синхронизация завершена")
+
+    @app.cli.command('rebuild-conversations')
+    def rebuild_conversations_command():
+        rebuild_conversations()
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        rebuild_search_index()
+
+    @app.cli.command('reap-files')
+    @click.option('--dry-run/--delete', default=None,
+                  help='Только подсчитать или удалить (по умолчанию FILE_REAPER_DRY_RUN)')
+    def reap_files_command(dry_run):
+        file_reaper.run_once(dry_run=dry_run)
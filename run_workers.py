@@ -0,0 +1,124 @@
+"""Запуск нескольких воркеров за балансировщиком.
+
+Каждый воркер - отдельный процесс eventlet на своем порту (BASE_PORT, BASE_PORT + 1, ...).
+Миграции выполняются один раз в родительском процессе, фоновая очистка старых файлов -
+только в первом воркере.
+
+Для нескольких воркеров нужны общие компоненты (.env):
+    SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/1   события из любого воркера, HTTP-маршрутов
+                                                      и CLI (flask sync-ad) доходят до всех клиентов
+    PRESENCE_BACKEND=redis                            общий реестр онлайн-пользователей
+    PRESENCE_REDIS_URL=redis://localhost:6379/0
+
+Балансировщик должен закреплять клиента за воркером (sticky sessions): Engine.IO
+в режиме long-polling отправляет запросы одной сессии на один и тот же процесс.
+Пример для nginx:
+
+    upstream chat_workers {
+        ip_hash;
+        server 127.0.0.1:5001;
+        server 127.0.0.1:5002;
+        server 127.0.0.1:5003;
+        server 127.0.0.1:5004;
+    }
+
+    server {
+        location / {
+            proxy_pass http://chat_workers;
+            proxy_http_version 1.1;
+            proxy_set_header Upgrade $http_upgrade;
+            proxy_set_header Connection "upgrade";
+            proxy_set_header Host $host;
+            proxy_read_timeout 360s;
+        }
+
+        # Файлы отдает nginx после проверки доступа приложением (DOWNLOAD_ACCEL_REDIRECT=/protected-files/)
+        location /protected-files/ {
+            internal;
+            alias /srv/chat/uploads/;
+        }
+    }
+
+Запуск: python run_workers.py --workers 4 --base-port 5001
+"""
+import os
+import sys
+import signal
+import argparse
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def serve(host, port, reaper=False):
+    # Клиент Redis и прочие сетевые библиотеки должны работать через зеленые потоки
+    import eventlet
+    eventlet.monkey_patch()
+
+    from app import app, socketio
+    from file_reaper import file_reaper
+    if reaper:
+        file_reaper.start(app)
+    print(f"🚀 Воркер {os.getpid()} слушает {host}:{port}")
+    socketio.run(app, host=host, port=port, debug=False, use_reloader=False, log_output=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Запуск нескольких воркеров приложения')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', 4)))
+    parser.add_argument('--host', default=os.getenv('HOST', '127.0.0.1'))
+    parser.add_argument('--base-port', type=int, default=int(os.getenv('BASE_PORT', 5001)))
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--reaper', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.host, args.base_port, args.reaper)
+        return
+
+    if args.workers > 1:
+        if not os.getenv('SOCKETIO_MESSAGE_QUEUE'):
+            print("❌ Для нескольких воркеров задайте SOCKETIO_MESSAGE_QUEUE")
+            sys.exit(1)
+        write_behind = os.getenv('MESSAGE_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+        if write_behind and os.getenv('DATABASE_URI', 'sqlite:///social.db').startswith('sqlite'):
+            # Id сообщений в SQLite выдает счетчик процесса - у воркеров они совпадут
+            print("❌ MESSAGE_WRITE_BEHIND с SQLite допустим только для одного воркера")
+            sys.exit(1)
+        if os.getenv('PRESENCE_BACKEND', 'memory') != 'redis':
+            print("⚠️ PRESENCE_BACKEND=memory: каждый воркер видит только своих онлайн-пользователей")
+
+    from app import init_app
+    init_app()
+
+    workers = []
+    for i in range(args.workers):
+        port = args.base_port + i
+        command = [
+            sys.executable, os.path.abspath(__file__), '--serve',
+            '--host', args.host, '--base-port', str(port)
+        ]
+        # Очистку старых файлов ведет только первый воркер
+        if i == 0:
+            command.append('--reaper')
+        workers.append(subprocess.Popen(command))
+    print(f"👥 Запущено воркеров: {len(workers)}, порты {args.base_port}-{args.base_port + args.workers - 1}")
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        stop(None, None)
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# search.py
+import re
+import base64
+import binascii
+from flask import current_app
+from sqlalchemy import text
+from extensions import db
+from models import File, Message
+
+# Полнотекстовый индекс сообщений (текст и имена файлов):
+#   SQLite     - виртуальная таблица FTS5 message_fts, rowid = message.id, ранжирование bm25
+#   PostgreSQL - таблица message_search с tsvector и GIN-индексом, ранжирование ts_rank
+# Индекс пополняется в той же транзакции, что и сообщение (record_message).
+
+MAX_QUERY_TOKENS = 10
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# remove_diacritics в FTS5 касается только латиницы, а ё и е в переписке взаимозаменяемы
+YO_TABLE = str.maketrans('ёЁ', 'еЕ')
+
+
+def _normalize(value):
+    return (value or '').translate(YO_TABLE)
+
+
+def search_backend():
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return 'fts5'
+    if dialect == 'postgresql':
+        return 'tsvector'
+    return None
+
+
+def create_search_index(connection):
+    """DDL индекса для текущей БД (миграция 7)"""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts "
+            "USING fts5(content, filenames, tokenize='unicode61 remove_diacritics 2')"
+        ))
+    elif dialect == 'postgresql':
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS message_search ("
+            "message_id INTEGER PRIMARY KEY REFERENCES message(id) ON DELETE CASCADE, "
+            "document TSVECTOR NOT NULL)"
+        ))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_message_search_document ON message_search USING GIN (document)"
+        ))
+    else:
+        print(f"⚠️ Полнотекстовый поиск не поддерживается для {dialect}")
+
+
+def _index_rows(rows):
+    """Добавляет или заменяет строки индекса: [{'id', 'content', 'filenames'}]"""
+    backend = search_backend()
+    if not rows or backend is None:
+        return
+    rows = [dict(row, content=_normalize(row['content']), filenames=_normalize(row['filenames'])) for row in rows]
+    if backend == 'fts5':
+        # FTS5 не поддерживает UPSERT - старую строку удаляем явно
+        db.session.execute(text("DELETE FROM message_fts WHERE rowid = :id"), rows)
+        db.session.execute(text(
+            "INSERT INTO message_fts (rowid, content, filenames) VALUES (:id, :content, :filenames)"
+        ), rows)
+    else:
+        db.session.execute(text(
+            "INSERT INTO message_search (message_id, document) "
+            "VALUES (:id, to_tsvector(CAST(:config AS regconfig), :content || ' ' || :filenames)) "
+            "ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document"
+        ), [dict(row, config=current_app.config['SEARCH_TS_CONFIG']) for row in rows])
+
+
+def index_message(message, filenames=()):
+    _index_rows([{
+        'id': message.id,
+        'content': message.content or '',
+        'filenames': ' '.join(filenames)
+    }])
+
+
+def rebuild_search_index(batch_size=1000):
+    """Переиндексирует всю историю пачками по id; каждая пачка - отдельная транзакция"""
+    backend = search_backend()
+    if backend is None:
+        print("⚠️ Полнотекстовый поиск не поддерживается для этой БД")
+        return 0
+
+    db.session.execute(text("DELETE FROM message_fts" if backend == 'fts5' else "DELETE FROM message_search"))
+    db.session.commit()
+
+    total = 0
+    last_id = 0
+    while True:
+        messages = db.session.query(Message.id, Message.content) \
+            .filter(Message.id > last_id) \
+            .order_by(Message.id) \
+            .limit(batch_size) \
+            .all()
+        if not messages:
+            break
+        last_id = messages[-1].id
+
+        filenames = {}
+        for message_id, filename in db.session.query(File.message_id, File.filename) \
+                .filter(File.message_id.in_([m.id for m in messages])):
+            filenames.setdefault(message_id, []).append(filename)
+
+        _index_rows([{
+            'id': m.id,
+            'content': m.content or '',
+            'filenames': ' '.join(filenames.get(m.id, []))
+        } for m in messages])
+        db.session.commit()
+        total += len(messages)
+
+    print(f"🔎 Поисковый индекс пересобран: {total} сообщений")
+    return total
+
+
+def encode_search_cursor(score, message_id):
+    """Курсор keyset-пагинации по (релевантность, id); repr сохраняет float без потерь"""
+    raw = f"{score!r}|{message_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        score, message_id = raw.split('|', 1)
+        return float(score), int(message_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Некорректный курсор: {cursor}")
+
+
+def _tokens(query):
+    return TOKEN_RE.findall(_normalize(query).lower())[:MAX_QUERY_TOKENS]
+
+
+def search_messages(user_id, query, peer_id=None, cursor=None, limit=20):
+    """Сообщения диалогов пользователя, подходящие под запрос, от самых релевантных.
+
+    Каждое слово запроса ищется по префиксу, все слова обязательны. Доступ - как у
+    файлов: пользователь видит только сообщения, где он отправитель или получатель.
+    Возвращает ([(id, score)], next_cursor); меньший score - выше в выдаче.
+    """
+    backend = search_backend()
+    tokens = _tokens(query)
+    if backend is None or not tokens:
+        return [], None
+
+    params = {'user_id': user_id, 'limit': limit + 1}
+    if backend == 'fts5':
+        # Слова в кавычках: пользовательский ввод не разбирается как синтаксис FTS5
+        params['query'] = ' '.join(f'"{token}"*' for token in tokens)
+        matches = (
+            "SELECT message.id AS id, bm25(message_fts) AS score FROM message_fts "
+            "JOIN message ON message.id = message_fts.rowid "
+            "WHERE message_fts MATCH :query"
+        )
+    else:
+        params['query'] = ' & '.join(f"{token}:*" for token in tokens)
+        params['config'] = current_app.config['SEARCH_TS_CONFIG']
+        # ts_rank тем больше, чем релевантнее - меняем знак, чтобы порядок совпадал с bm25
+        matches = (
+            "SELECT message.id AS id, "
+            "CAST(-ts_rank(message_search.document, to_tsquery(CAST(:config AS regconfig), :query)) AS DOUBLE PRECISION) "
+            "AS score FROM message_search "
+            "JOIN message ON message.id = message_search.message_id "
+            "WHERE message_search.document @@ to_tsquery(CAST(:config AS regconfig), :query)"
+        )
+
+    matches += " AND (message.sender_id = :user_id OR message.recipient_id = :user_id)"
+    if peer_id is not None:
+        matches += " AND (message.sender_id = :peer_id OR message.recipient_id = :peer_id)"
+        params['peer_id'] = peer_id
+
+    sql = f"SELECT id, score FROM ({matches}) AS matches"
+    if cursor:
+        params['score'], params['after_id'] = cursor
+        sql += " WHERE score > :score OR (score = :score AND id < :after_id)"
+    sql += " ORDER BY score, id DESC LIMIT :limit"
+
+    rows = db.session.execute(text(sql), params).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_search_cursor(rows[-1].score, rows[-1].id) if has_more and rows else None
+    return rows, next_cursor
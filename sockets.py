@@ -2,8 +2,11 @@ import datetime
 from flask import session, request
 from flask_socketio import emit, join_room, leave_room
 from extensions import db
-from models import User, Message
-from utils import active_users, get_chat_room_name, update_online_users
+from models import Message
+from utils import (get_chat_room_name, get_presence_snapshot, queue_presence_change, start_presence_sweeper, record_message,
+                   build_message_payload, dispatch_message, mark_read_up_to, emit_messages_read)
+from presence import presence
+from message_writer import message_writer
 
 def init_socket_handlers(socketio):
     @socketio.on('connect')
@@ -11,14 +14,14 @@ def init_socket_handlers(socketio):
         print(f"⚡️ Новое подключение: {request.sid}")
         if 'user_id' in session:
             user_id = session['user_id']
-            active_users[user_id] = {
-                'sid': request.sid,
-                'room': None
-            }
+            became_online = presence.connect(user_id, request.sid)
+            start_presence_sweeper(socketio)
             join_room(f"user_{user_id}")
             print(f"👤 Пользователь {user_id} подключен. SID: {request.sid}")
             emit('connection_success', {'message': 'Успешное подключение к WebSocket'})
-            update_online_users(socketio)
+            emit('presence_snapshot', {'users': get_presence_snapshot()})
+            if became_online:
+                queue_presence_change(socketio, joined=[user_id])
         else:
             print("⚠️ Подключение без аутентификации")
             emit('reconnect_required', {'reason': 'Требуется аутентификация'})
@@ -28,16 +31,25 @@ def init_socket_handlers(socketio):
         print(f"❌ Отключение: {request.sid}")
         if 'user_id' in session:
             user_id = session['user_id']
-            if user_id in active_users:
-                del active_users[user_id]
-            print(f"👤 Пользователь {user_id} отключен")
-            update_online_users(socketio)
+            # Пользователь остается онлайн, пока открыта хотя бы одна его вкладка
+            if presence.disconnect(user_id, request.sid):
+                print(f"👤 Пользователь {user_id} отключен")
+                queue_presence_change(socketio, left=[user_id])
+
+    @socketio.on('presence_heartbeat')
+    def handle_presence_heartbeat(data=None):
+        user_id = session.get('user_id')
+        if user_id and presence.heartbeat(user_id, request.sid):
+            # Сессию уже сочли истекшей и разослали presence_leave
+            queue_presence_change(socketio, joined=[user_id])
 
     @socketio.on('leave_room')
     def handle_leave_room(data):
         room = data.get('room')
         if room:
             leave_room(room)
+            if 'user_id' in session and presence.set_room(session['user_id'], request.sid, None):
+                queue_presence_change(socketio, joined=[session['user_id']])
             print(f"👤 Пользователь {session.get('user_id', 'unknown')} вышел из комнаты: {room}")
 
     @socketio.on('join_chat')
@@ -51,13 +63,8 @@ def init_socket_handlers(socketio):
         try:
             room = data.get('room', get_chat_room_name(user_id, recipient_id))
 
-            if user_id in active_users:
-                active_users[user_id]['room'] = room
-            else:
-                active_users[user_id] = {
-                    'sid': request.sid,
-                    'room': room
-                }
+            if presence.set_room(user_id, request.sid, room):
+                queue_presence_change(socketio, joined=[user_id])
 
             print(f"👤 Пользователь {user_id} присоединился к комнате чата: {room}")
             join_room(room)
@@ -74,17 +81,32 @@ def init_socket_handlers(socketio):
         recipient_id = data['recipient_id']
         room = get_chat_room_name(user_id, recipient_id)
 
-        if user_id in active_users:
-            active_users[user_id]['room'] = room
-        else:
-            active_users[user_id] = {
-                'sid': request.sid,
-                'room': room
-            }
+        if presence.set_room(user_id, request.sid, room):
+            queue_presence_change(socketio, joined=[user_id])
 
         join_room(room)
         print(f"🔄 Пользователь {user_id} обновил присутствие в комнате: {room}")
 
+    @socketio.on('mark_read')
+    def handle_mark_read(data):
+        user_id = session.get('user_id')
+        if not user_id:
+            return
+
+        try:
+            peer_id = int(data['sender_id'])
+            up_to_id = data.get('up_to_id')
+            up_to_id = int(up_to_id) if up_to_id is not None else None
+
+            read_count = mark_read_up_to(user_id, peer_id, up_to_id)
+            db.session.commit()
+            if read_count:
+                emit_messages_read(socketio, user_id, peer_id, up_to_id, read_count)
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Ошибка при отметке сообщений прочитанными: {str(e)}")
+            emit('error', {'message': 'Не удалось отметить сообщения прочитанными'}, room=request.sid)
+
     @socketio.on('send_message')
     def handle_send_message(data):
         print(f"✉️ Получено сообщение: {data}")
@@ -111,67 +133,26 @@ def init_socket_handlers(socketio):
                 recipient_id=recipient_id,
                 is_read=False
             )
-            db.session.add(message)
-            db.session.commit()
-            print(f"📝 Сообщение создано в БД, ID: {message.id}")
-
-            room = get_chat_room_name(user_id, recipient_id)
-            sender = User.query.get(user_id)
-
-            message_data = {
-                'id': message.id,
-                'sender_id': user_id,
-                'recipient_id': recipient_id,
-                'sender_name': sender.fullname,
-                'content': content,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
-                'room': room,
-                'is_read': False,
-                'files': []
-            }
-
-            emit('new_message', message_data, room=room)
-            print(f"📤 Сообщение отправлено в комнату: {room}")
-
-            notification_data = {
-                'sender_id': user_id,
-                'sender_name': sender.fullname,
-                'content': content,
-                'room': room,
-                'message_id': message.id,
-                'recipient_id': recipient_id,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }
-
-            recipient_info = active_users.get(recipient_id)
-            is_recipient_online = recipient_info and recipient_info.get('room') == room
-
-            if is_recipient_online:
-                emit('new_message_notification', notification_data, room=f"user_{recipient_id}")
-                print(f"🔔 Уведомление отправлено пользователю {recipient_id}")
+            if message_writer.enabled:
+                # Рассылаем сразу, запись и подтверждение доставки - после групповой фиксации
+                message.id = message_writer.allocate_id()
+                message.timestamp = datetime.datetime.utcnow()
+                payload = build_message_payload(message)
+                if not message_writer.submit(message, sid=request.sid, temp_id=temp_id):
+                    print(f"⏳ Очередь записи переполнена, сообщение от {user_id} отклонено")
+                    emit('error', {'message': 'Сервер перегружен, повторите отправку',
+                                   'temp_id': temp_id}, room=request.sid)
+                    return
+                dispatch_message(socketio, payload, push_unread=False)
             else:
-                print(f"🔕 Пользователь {recipient_id} не в текущем чате или не онлайн")
-
-            emit('message_delivered', {
-                'temp_id': temp_id,
-                'message_id': message.id,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }, room=request.sid)
-
-            emit('inbox_update', {
-                'user_id': user_id,
-                'recipient_id': recipient_id,
-                'content': content,
-                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-            }, room=f"user_{user_id}")
-
-            if recipient_id in active_users:
-                emit('inbox_update', {
-                    'user_id': recipient_id,
-                    'sender_id': user_id,
-                    'content': content,
-                    'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
-                }, room=f"user_{recipient_id}")
+                db.session.add(message)
+                db.session.flush()
+                record_message(message)
+                payload = build_message_payload(message)
+                db.session.commit()
+                print(f"📝 Сообщение создано в БД, ID: {payload['id']}")
+                dispatch_message(socketio, payload, sid=request.sid, temp_id=temp_id)
+            print(f"📤 Сообщение отправлено в комнату: {payload['room']}")
 
             print(f"✅ Сообщение успешно отправлено и сохранено")
 
@@ -5,7 +5,7 @@ from ldap3 import Server, Connection, ALL, NTLM
 load_dotenv()
 
 
-def test_ldap():
+def check_ldap():
     server = os.getenv('LDAP_SERVER')
     domain = os.getenv('LDAP_DOMAIN')
     username = os.getenv('LDAP_SERVICE_ACCOUNT')
@@ -41,5 +41,13 @@ def test_ldap():
     return False
 
 
+def test_ldap():
+    # Нужен настоящий контроллер домена из .env; без него проверка под pytest пропускается
+    if not os.getenv('LDAP_SERVER') or not os.getenv('LDAP_SERVICE_PASSWORD'):
+        import pytest
+        pytest.skip("LDAP_SERVER и LDAP_SERVICE_PASSWORD не заданы")
+    assert check_ldap(), "All authentication attempts failed"
+
+
 if __name__ == '__main__':
-    test_ldap()
\ No newline at end of file
+    check_ldap()
\ No newline at end of file
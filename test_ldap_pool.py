@@ -0,0 +1,123 @@
+"""Локальная проверка пула соединений сервисной учетной записи LDAP.
+
+Контроллер домена не нужен: LDAP_CLIENT_STRATEGY=MOCK_SYNC включает встроенный в ldap3
+фиктивный сервер, в который заранее добавляется сервисная учетная запись.
+Проверяются выдача и возврат соединения, переподключение после разрыва и
+ожидание свободного соединения в исчерпанном пуле.
+
+Запуск: python test_ldap_pool.py (или pytest)
+"""
+import sys
+import time
+from flask import Flask
+from ldap3 import Connection, MOCK_SYNC
+from auth import service_connection, ldap_pool, init_ldap_pool
+
+USER_OU = 'OU=Users,DC=corp,DC=local'
+
+
+def _pool_app():
+    # Отдельное приложение только с настройками пула: app.py здесь не нужен
+    app = Flask('ldap_pool_test')
+    app.config.update(
+        LDAP_SERVER='mock-dc',
+        LDAP_DOMAIN='corp.local',
+        LDAP_USER_OU=USER_OU,
+        LDAP_SERVICE_ACCOUNT='svc',
+        LDAP_SERVICE_PASSWORD='secret',
+        LDAP_CLIENT_STRATEGY=MOCK_SYNC,
+        LDAP_POOL_SIZE=2,
+        LDAP_POOL_MAX_IDLE=300,
+    )
+    return app
+
+
+def _populate(server):
+    """Сервисная учетная запись на фиктивном сервере (записи общие для всех соединений)"""
+    conn = Connection(server, client_strategy=MOCK_SYNC)
+    conn.bind()
+    conn.strategy.add_entry(
+        f"CN=svc,{USER_OU}",
+        {'objectClass': 'user', 'sAMAccountName': 'svc', 'userPassword': 'secret'}
+    )
+    conn.unbind()
+
+
+def check(condition, message):
+    assert condition, message
+    print(f"Success! {message}")
+
+
+def _check_checkout_return():
+    print("\nCheckout / return")
+    # Очередь слотов - FIFO: возвращенное соединение снова выдается после обхода всего пула
+    seen = []
+    for _ in range(ldap_pool.size * 3):
+        with service_connection() as conn:
+            seen.append((conn, conn.bound))
+    check(all(bound for _, bound in seen), "every checked out connection is bound")
+    seen = [conn for conn, _ in seen]
+    distinct = {id(conn) for conn in seen}
+    check(len(distinct) == ldap_pool.size, f"{len(seen)} checkouts served by {len(distinct)} connections")
+    check(seen[0] is seen[ldap_pool.size], "returned connection is reused")
+
+
+def _check_rebind_after_drop():
+    print("\nRebind after a dropped connection")
+
+    # Разрыв внутри service_connection: соединение закрыто и выбрасывается при возврате
+    with service_connection() as conn:
+        dropped = conn
+        conn.unbind()
+    with service_connection() as conn:
+        check(conn is not dropped and conn.bound, "closed connection replaced on return")
+
+    # Разрыв у соединения, уже лежащего в пуле: замечается при следующей выдаче
+    conn = ldap_pool.acquire()
+    ldap_pool.release(conn)
+    conn.unbind()
+    fresh = ldap_pool.acquire()
+    try:
+        check(fresh is not conn and fresh.bound, "stale pooled connection rebound on checkout")
+    finally:
+        ldap_pool.release(fresh)
+
+
+def _check_exhausted_pool():
+    print("\nExhausted pool timeout")
+    held = [ldap_pool.acquire() for _ in range(ldap_pool.size)]
+    started = time.monotonic()
+    try:
+        try:
+            ldap_pool.acquire(timeout=0.2)
+        except Exception as e:
+            waited = time.monotonic() - started
+            check(0.2 <= waited < 2, f"acquire timed out after {waited:.2f}s: {str(e)}")
+        else:
+            check(False, "acquire on an exhausted pool must fail")
+    finally:
+        for conn in held:
+            ldap_pool.release(conn)
+
+    conn = ldap_pool.acquire(timeout=0.2)
+    ldap_pool.release(conn)
+    check(conn.bound, "pool usable after connections are returned")
+
+
+def test_ldap_pool():
+    app = _pool_app()
+    with app.app_context():
+        init_ldap_pool(app)
+        print(f"Pool size: {ldap_pool.size}, strategy: {ldap_pool.client_strategy}")
+        _populate(ldap_pool.server)
+        _check_checkout_return()
+        _check_rebind_after_drop()
+        _check_exhausted_pool()
+
+
+if __name__ == '__main__':
+    try:
+        test_ldap_pool()
+    except AssertionError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
@@ -0,0 +1,146 @@
+"""Локальная проверка доставки событий между воркерами через очередь сообщений.
+
+Redis не нужен: вместо брокера используется транспорт kombu memory:// (брокер в памяти
+процесса). Воркер A - само приложение, воркер B - второй сервер Socket.IO, подключенный
+к той же очереди. Клиент (сессия в комнате user_<id>) есть только на B и должен получить
+события, отправленные HTTP-маршрутом воркера A и процессом без сервера (как CLI).
+
+Сценарию нужны eventlet.monkey_patch() и свои переменные окружения до импорта app,
+поэтому под pytest он запускается отдельным процессом.
+
+Запуск: pip install kombu && python test_message_queue.py (или pytest)
+"""
+import os
+import sys
+import tempfile
+import subprocess
+
+
+def _configure():
+    import eventlet
+    eventlet.monkey_patch()
+
+    tmp_dir = tempfile.mkdtemp()
+    os.environ.update(
+        DATABASE_URI=f"sqlite:///{os.path.join(tmp_dir, 'mq.db')}",
+        UPLOAD_FOLDER=os.path.join(tmp_dir, 'uploads'),
+        SOCKETIO_MESSAGE_QUEUE='memory://',
+        SOCKETIO_CHANNEL='mq-test',
+    )
+
+
+class WorkerSession:
+    """Сессия клиента на сервере Socket.IO: пакеты, отправленные ей, складываются в список.
+
+    Тестовый клиент Flask-SocketIO не работает с очередью сообщений, поэтому сессия
+    регистрируется в менеджере напрямую, как это делает сервер при подключении.
+    """
+
+    def __init__(self, socketio, room):
+        from socketio import packet
+
+        self.socketio = socketio
+        self.received = []
+        server = socketio.server
+        send_eio_packet = server._send_eio_packet
+        self.eio_sid = 'worker-b-client'
+
+        def capture(eio_sid, eio_pkt):
+            if eio_sid == self.eio_sid:
+                pkt = packet.Packet(encoded_packet=eio_pkt.data)
+                self.received.append((pkt.data[0], pkt.data[1]))
+            else:
+                send_eio_packet(eio_sid, eio_pkt)
+
+        server._send_eio_packet = capture
+        server.manager.initialize()
+        server.manager_initialized = True
+        self.sid = server.manager.connect(self.eio_sid, '/')
+        server.manager.enter_room(self.sid, '/', room)
+        # Даем фоновому слушателю очереди подписаться до первых событий
+        socketio.sleep(0.5)
+
+    def wait_for(self, event, match=lambda data: True, timeout=5.0):
+        waited = 0.0
+        while waited < timeout:
+            matches = [data for name, data in self.received if name == event and match(data)]
+            if matches:
+                return matches
+            self.socketio.sleep(0.1)
+            waited += 0.1
+        return []
+
+
+def check(condition, message):
+    assert condition, message
+    print(f"Success! {message}")
+
+
+def _run_message_queue():
+    from flask import Flask, session
+    from flask_socketio import SocketIO
+    from app import app, init_app
+    from extensions import auth, db
+    from models import User
+    from presence import presence
+
+    init_app()
+    with app.app_context():
+        sender = User(username='mq_sender', fullname='Отправитель')
+        recipient = User(username='mq_recipient', fullname='Получатель')
+        db.session.add_all([sender, recipient])
+        db.session.commit()
+        sender_id, recipient_id = sender.id, recipient.id
+
+    # Проверка пароля через LDAP здесь не нужна
+    @auth.verify_password
+    def verify_local(username, password):
+        user = User.query.filter_by(username=username).first()
+        if user:
+            session['user_id'] = user.id
+            return username
+
+    # Воркер B: отдельный сервер Socket.IO, подключенный к той же очереди
+    worker_b = Flask('worker_b')
+    socketio_b = SocketIO(worker_b, async_mode='eventlet',
+                          message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                          channel=app.config['SOCKETIO_CHANNEL'])
+    client = WorkerSession(socketio_b, f"user_{recipient_id}")
+    # В одном процессе реестр присутствия в памяти общий для обоих воркеров, как Redis в бою
+    presence.connect(recipient_id, client.sid)
+    print(f"Client session on worker B: {client.sid}")
+
+    print("\nHTTP route on worker A -> client on worker B")
+    response = app.test_client().post(
+        '/send_message',
+        json={'recipient_id': recipient_id, 'content': 'через очередь'},
+        headers={'Authorization': 'Basic bXFfc2VuZGVyOng='}  # mq_sender:x
+    )
+    print(f"POST /send_message: {response.status_code}")
+    check(client.wait_for('new_message', lambda data: data.get('sender_id') == sender_id),
+          "new_message delivered")
+
+    print("\nWrite-only emitter (as in CLI) -> client on worker B")
+    emitter = SocketIO(message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                       channel=app.config['SOCKETIO_CHANNEL'])
+    emitter.emit('unread_count', {'count': 42}, room=f"user_{recipient_id}")
+    check(client.wait_for('unread_count', lambda data: data.get('count') == 42),
+          "unread_count delivered")
+
+
+def test_message_queue():
+    import pytest
+    pytest.importorskip('kombu')
+    result = subprocess.run([sys.executable, os.path.abspath(__file__)],
+                            capture_output=True, text=True, timeout=120)
+    print(result.stdout)
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+
+
+if __name__ == '__main__':
+    _configure()
+    try:
+        _run_message_queue()
+    except AssertionError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
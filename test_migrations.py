@@ -0,0 +1,116 @@
+"""Проверка обновления схемы с базы, созданной исходной версией приложения.
+
+База собирается DDL таблиц в том виде, в каком их создавал db.create_all() до
+появления версионированных миграций, заполняется данными, после чего
+init_database() должна пройти все шаги MIGRATIONS и привести схему к текущей модели.
+
+Запуск: python test_migrations.py (или pytest)
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+from flask import Flask
+from sqlalchemy import inspect, func
+from extensions import db
+from models import Conversation, File, Message, SchemaVersion, User
+from utils import MIGRATIONS, init_database
+
+BASELINE_SCHEMA = """
+CREATE TABLE user (
+    id INTEGER NOT NULL PRIMARY KEY,
+    username VARCHAR(80) NOT NULL UNIQUE,
+    fullname VARCHAR(120) NOT NULL,
+    email VARCHAR(120),
+    department VARCHAR(120),
+    position VARCHAR(120),
+    is_active BOOLEAN,
+    last_seen DATETIME,
+    password_hash VARCHAR(128)
+);
+CREATE TABLE post (
+    id INTEGER NOT NULL PRIMARY KEY,
+    content TEXT NOT NULL,
+    timestamp DATETIME,
+    user_id INTEGER NOT NULL REFERENCES user (id)
+);
+CREATE INDEX ix_post_timestamp ON post (timestamp);
+CREATE TABLE message (
+    id INTEGER NOT NULL PRIMARY KEY,
+    content TEXT,
+    timestamp DATETIME,
+    sender_id INTEGER NOT NULL REFERENCES user (id),
+    recipient_id INTEGER NOT NULL REFERENCES user (id),
+    is_read BOOLEAN
+);
+CREATE INDEX ix_message_timestamp ON message (timestamp);
+CREATE TABLE file (
+    id INTEGER NOT NULL PRIMARY KEY,
+    filename VARCHAR(255) NOT NULL,
+    upload_date DATETIME,
+    user_id INTEGER NOT NULL REFERENCES user (id),
+    message_id INTEGER REFERENCES message (id),
+    filesize BIGINT
+);
+INSERT INTO user (id, username, fullname, is_active) VALUES (1, 'ivan', 'Иван', 1), (2, 'petr', 'Петр', 1);
+INSERT INTO message (id, content, timestamp, sender_id, recipient_id, is_read) VALUES
+    (1, 'привет', '2024-01-01 10:00:00', 1, 2, 1),
+    (2, 'отчет во вложении', '2024-01-01 10:05:00', 2, 1, 0);
+INSERT INTO file (id, filename, upload_date, user_id, message_id, filesize) VALUES
+    (1, 'report.pdf', '2024-01-01 10:05:00', 2, 2, 1024);
+"""
+
+
+def _baseline_app():
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'baseline.db')
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+
+    app = Flask('migration_test')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}",
+        SEARCH_TS_CONFIG='russian',
+        UPLOAD_FOLDER=os.path.join(tmp_dir, 'uploads'),
+    )
+    db.init_app(app)
+    return app
+
+
+def test_upgrade_from_baseline():
+    app = _baseline_app()
+    init_database(db, app)
+
+    with app.app_context():
+        inspector = inspect(db.engine)
+        file_columns = {column['name'] for column in inspector.get_columns('file')}
+        user_columns = {column['name'] for column in inspector.get_columns('user')}
+        assert {'blob_hash'} <= file_columns
+        assert {'is_admin', 'unread_count'} <= user_columns
+
+        indexes = {index['name'] for index in inspector.get_indexes('file')} | \
+                  {index['name'] for index in inspector.get_indexes('message')}
+        assert {'ix_file_blob_hash', 'ix_file_message_id', 'ix_message_recipient_is_read'} <= indexes
+
+        assert db.session.query(func.max(SchemaVersion.version)).scalar() == MIGRATIONS[-1][0]
+        assert Message.query.count() == 2 and File.query.count() == 1
+
+        # Диалоги и счетчики непрочитанных восстановлены по истории
+        conversation = Conversation.query.filter_by(user_id=1, peer_id=2).one()
+        assert conversation.last_message_id == 2 and conversation.unread_count == 1
+        assert db.session.get(User, 1).unread_count == 1
+        db.session.remove()
+
+    # Повторный запуск на обновленной базе ничего не ломает
+    init_database(db, app)
+    print("Success! baseline database upgraded")
+
+
+if __name__ == '__main__':
+    try:
+        test_upgrade_from_baseline()
+    except AssertionError:
+        import traceback
+        traceback.print_exc()
+        print("Error: migration check failed")
+        sys.exit(1)
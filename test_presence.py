@@ -0,0 +1,163 @@
+"""Локальная проверка хранилищ присутствия (в памяти и в Redis) одним сценарием.
+
+Redis не нужен: RedisPresenceStore получает клиента fakeredis, если он установлен,
+иначе - небольшой клиент в памяти ниже с нужным подмножеством команд.
+TTL сокращен до секунды, поэтому проверка идет несколько секунд реального времени.
+
+Запуск: python test_presence.py (или pytest)
+"""
+import sys
+import time
+from presence import MemoryPresenceStore, RedisPresenceStore, PresenceRegistry
+
+TTL = 1
+
+
+def _score(value):
+    return float(value)  # float('-inf') / float('+inf') тоже разбираются
+
+
+class FakeRedisPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+class FakeRedis:
+    """Команды Redis, которыми пользуется RedisPresenceStore (decode_responses=True)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+    def _sorted(self, key):
+        return sorted(self.data.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def zadd(self, key, mapping):
+        zset = self.data.setdefault(key, {})
+        added = sum(1 for member in mapping if str(member) not in zset)
+        zset.update({str(member): float(score) for member, score in mapping.items()})
+        return added
+
+    def zrem(self, key, *members):
+        zset = self.data.get(key, {})
+        return sum(1 for member in members if zset.pop(str(member), None) is not None)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.data.get(key, {})
+        removed = [member for member, score in zset.items() if _score(low) <= score <= _score(high)]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zscore(self, key, member):
+        return self.data.get(key, {}).get(str(member))
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self._sorted(key) if _score(low) <= score <= _score(high)]
+
+    def zrange(self, key, start, end, withscores=False):
+        items = self._sorted(key)[start:None if end == -1 else end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+        return 1
+
+    def hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        return sum(1 for field in fields if values.pop(field, None) is not None)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        # Ключи здесь не истекают сами: сценарий укладывается в ttl * 2
+        return key in self.data
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+
+def _redis_client():
+    try:
+        import fakeredis
+        return fakeredis.FakeRedis(decode_responses=True)
+    except ImportError:
+        return FakeRedis()
+
+
+def check(condition, message):
+    assert condition, message
+    print(f"Success! {message}")
+
+
+def _run_scenario(store):
+    presence = PresenceRegistry()
+    presence.store = store
+
+    print("Multi-connection leave")
+    check(presence.connect(1, 'tab-a'), "first session brings user online")
+    check(not presence.connect(1, 'tab-b'), "second session does not")
+    presence.set_room(1, 'tab-b', 'chat_1_2')
+    check(presence.in_room(1, 'chat_1_2'), "room of the second session is visible")
+    check(not presence.disconnect(1, 'tab-a'), "leaving one tab keeps user online")
+    check(presence.is_online(1), "user still online with one tab")
+    check(presence.disconnect(1, 'tab-b'), "leaving the last tab reports offline")
+    check(not presence.is_online(1) and 1 not in presence.online_ids(), "user is offline")
+
+    print("Heartbeat")
+    presence.connect(2, 'tab-a')
+    presence.connect(3, 'tab-a')
+    presence.connect(3, 'tab-b')
+    for _ in range(3):
+        time.sleep(TTL * 0.6)
+        presence.heartbeat(2, 'tab-a')
+        presence.heartbeat(3, 'tab-b')
+    check(presence.is_online(2), "heartbeat keeps user online past the TTL")
+    offline = presence.expire()
+    check(not offline, f"sweeper keeps users with a live session (offline: {sorted(offline)})")
+    check(presence.is_online(3), "stale tab does not take the user offline")
+
+    print("Sweeper expiry")
+    time.sleep(TTL * 1.2)
+    check(not presence.is_online(2), "user without heartbeat reads as offline")
+    offline = presence.expire()
+    check(offline == {2, 3}, f"sweeper reports expired users once: {sorted(offline)}")
+    check(not presence.expire(), "second sweep reports nothing")
+    check(presence.connect(2, 'tab-c'), "reconnect after expiry brings user online again")
+    check(presence.heartbeat(3, 'tab-b'), "heartbeat of a live tab after expiry reports return")
+    check(presence.is_online(3) and 3 in presence.online_ids(), "returned user is listed online")
+    check(not presence.heartbeat(3, 'tab-b'), "next heartbeat is an ordinary one")
+    check(presence.disconnect(3, 'tab-b'), "returned tab is the only session again")
+    check(presence.set_room(3, 'tab-b', 'chat_1_3'), "set_room after going offline reports return")
+    check(presence.in_room(3, 'chat_1_3'), "room of the returned session is visible")
+
+
+def test_presence():
+    for store in (MemoryPresenceStore(ttl=TTL), RedisPresenceStore(_redis_client(), ttl=TTL)):
+        print(f"\n{type(store).__name__}")
+        _run_scenario(store)
+
+
+if __name__ == '__main__':
+    try:
+        test_presence()
+    except AssertionError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
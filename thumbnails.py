@@ -0,0 +1,181 @@
+# thumbnails.py
+import os
+import queue
+import secrets
+import threading
+from flask import current_app
+from models import Blob
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+
+class ThumbnailPipeline:
+    """Миниатюры изображений, создаваемые вне запроса.
+
+    После загрузки изображение ставится в ограниченную очередь (THUMBNAIL_QUEUE_SIZE),
+    которую разбирают THUMBNAIL_WORKERS фоновых задач. Миниатюры всех размеров лежат
+    рядом с блобом (<хеш>.<размер>.jpg) и, как и блоб, общие для одинакового содержимого.
+    Декодирование выполняется в пуле потоков eventlet, чтобы не блокировать цикл сервера.
+
+    Pillow - необязательная зависимость: без нее миниатюры отключены.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sizes = {}
+        self.workers = 2
+        self.wait_timeout = 5
+        self.max_source_size = 50 * 1024 * 1024
+        self._socketio = None
+        self._queue = None
+        self._pending = set()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def configure(self, app, socketio):
+        enabled = app.config['THUMBNAILS_ENABLED']
+        if enabled:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                print("⚠️ Pillow не установлен - миниатюры изображений отключены")
+                enabled = False
+
+        with self._lock:
+            self.enabled = enabled
+            self.sizes = {
+                'small': app.config['THUMBNAIL_SMALL_SIZE'],
+                'large': app.config['THUMBNAIL_LARGE_SIZE']
+            }
+            self.workers = app.config['THUMBNAIL_WORKERS']
+            self.wait_timeout = app.config['THUMBNAIL_WAIT']
+            self.max_source_size = app.config['THUMBNAIL_MAX_SOURCE_SIZE']
+            self._socketio = socketio
+            self._queue = socketio.server.eio.create_queue(maxsize=app.config['THUMBNAIL_QUEUE_SIZE'])
+            self._pending.clear()
+            self._started = False
+
+    def supports(self, file):
+        if not self.enabled or not file.blob_hash:
+            return False
+        if (file.filesize or 0) > self.max_source_size:
+            return False
+        return os.path.splitext(file.filename)[1].lower() in IMAGE_EXTENSIONS
+
+    def preview_urls(self, file):
+        """Ссылки на миниатюры для payload сообщения; пусто, если файл не изображение"""
+        if not self.supports(file):
+            return {}
+        return {
+            'thumbnail_url': f"/thumbnail/{file.id}/small",
+            'preview_url': f"/thumbnail/{file.id}/large"
+        }
+
+    def path(self, sha256, name):
+        return f"{Blob.path(sha256)}.{self.sizes[name]}.jpg"
+
+    def submit(self, file):
+        """Ставит создание миниатюр в очередь; False, если очередь переполнена"""
+        if not self.supports(file):
+            return False
+        sha256 = file.blob_hash
+        if all(os.path.exists(self.path(sha256, name)) for name in self.sizes):
+            return True
+
+        self._start()
+        with self._lock:
+            if sha256 in self._pending:
+                return True
+            self._pending.add(sha256)
+        try:
+            self._queue.put_nowait(sha256)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(sha256)
+            print(f"⚠️ Очередь миниатюр переполнена, пропущен {sha256}")
+            return False
+
+    def wait_for(self, file, name):
+        """Путь к готовой миниатюре; ждет фоновую обработку не дольше THUMBNAIL_WAIT"""
+        path = self.path(file.blob_hash, name)
+        if os.path.exists(path):
+            return path
+        if not self.submit(file):
+            return None
+
+        waited = 0.0
+        while waited < self.wait_timeout:
+            self._socketio.sleep(0.1)
+            waited += 0.1
+            if os.path.exists(path):
+                return path
+            with self._lock:
+                if file.blob_hash not in self._pending:
+                    break
+        return path if os.path.exists(path) else None
+
+    def _start(self):
+        app = current_app._get_current_object()
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.workers):
+            self._socketio.start_background_task(self._run, app)
+
+    def _run(self, app):
+        while True:
+            sha256 = self._queue.get()
+            try:
+                with app.app_context():
+                    targets = {size: self.path(sha256, name) for name, size in self.sizes.items()}
+                    source_path = Blob.path(sha256)
+                if not os.path.exists(source_path):
+                    # Блоб удален (purge_blobs), пока задача ждала в очереди
+                    continue
+                if self._socketio.server.eio.async_mode == 'eventlet':
+                    from eventlet import tpool
+                    tpool.execute(self._render, source_path, targets)
+                else:
+                    self._render(source_path, targets)
+            except Exception as e:
+                print(f"⚠️ Не удалось создать миниатюру {sha256}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending.discard(sha256)
+
+    @staticmethod
+    def _render(source_path, targets):
+        from PIL import Image, ImageOps
+
+        with Image.open(source_path) as image:
+            # Для JPEG декодируем сразу в уменьшенном масштабе
+            image.draft('RGB', (max(targets), max(targets)))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+
+            # От большего размера к меньшему: каждый следующий уменьшается из предыдущего
+            for size in sorted(targets, reverse=True):
+                image.thumbnail((size, size))
+                target = targets[size]
+                tmp_path = f"{target}.{secrets.token_hex(4)}.tmp"
+                image.save(tmp_path, 'JPEG', quality=85, optimize=True)
+                os.replace(tmp_path, target)
+
+        # Блоб удалили во время обработки: purge_blobs мог не увидеть миниатюры, убираем их сами
+        if not os.path.exists(source_path):
+            for target in targets.values():
+                if os.path.exists(target):
+                    os.remove(target)
+
+
+thumbnails = ThumbnailPipeline()
+
+
+def init_thumbnails(app, socketio):
+    thumbnails.configure(app, socketio)
@@ -0,0 +1,179 @@
+# uploads.py
+import os
+import re
+import json
+import time
+import fcntl
+import secrets
+import datetime
+from contextlib import contextmanager
+from flask import current_app
+from werkzeug.utils import secure_filename
+from blobstore import store_file
+
+# Размер блока при копировании тела запроса на диск
+COPY_BUFFER_SIZE = 64 * 1024
+PARTIAL_DIR = '.partial'
+UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.offset = offset
+
+
+def _partial_dir():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], PARTIAL_DIR)
+
+
+def _paths(upload_id):
+    if not UPLOAD_ID_RE.match(upload_id or ''):
+        raise UploadError('Загрузка не найдена', 404)
+    base = os.path.join(_partial_dir(), upload_id)
+    return base + '.json', base + '.part'
+
+
+def _load(upload_id, user_id):
+    meta_path, part_path = _paths(upload_id)
+    try:
+        with open(meta_path, encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        raise UploadError('Загрузка не найдена', 404)
+    if meta['user_id'] != user_id:
+        raise UploadError('Загрузка не найдена', 404)
+    meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return meta, meta_path, part_path
+
+
+def create_upload(user_id, recipient_id, filename, size):
+    """Начинает загрузку по частям: метаданные и пустой .part во временной папке"""
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise UploadError('Некорректное имя файла')
+    if size < 0 or size > current_app.config['UPLOAD_MAX_FILE_SIZE']:
+        raise UploadError('Файл слишком большой', 413)
+
+    os.makedirs(_partial_dir(), exist_ok=True)
+    upload_id = secrets.token_urlsafe(24)
+    meta_path, part_path = _paths(upload_id)
+    meta = {
+        'upload_id': upload_id,
+        'user_id': user_id,
+        'recipient_id': recipient_id,
+        'filename': filename,
+        'size': size,
+        'created': datetime.datetime.utcnow().isoformat() + 'Z'
+    }
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w', encoding='utf-8') as meta_file:
+        json.dump(meta, meta_file)
+    meta['offset'] = 0
+    return meta
+
+
+def get_upload(upload_id, user_id):
+    """Состояние загрузки; offset - сколько байт уже на диске (с него продолжается загрузка)"""
+    meta, _, _ = _load(upload_id, user_id)
+    return meta
+
+
+@contextmanager
+def _locked_part(part_path):
+    """Открывает .part на дозапись под эксклюзивной блокировкой.
+
+    Повтор PUT по таймауту может прийти, пока первый запрос еще пишет: без блокировки оба
+    прошли бы проверку смещения и дописали одни и те же байты. Блокировка не ждет -
+    второй запрос сразу получает 409 с текущим смещением.
+    """
+    try:
+        # Без O_CREAT: если загрузку уже завершили или удалили, файл не создается заново
+        fd = os.open(part_path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        raise UploadError('Загрузка не найдена', 404)
+    with os.fdopen(fd, 'ab') as part_file:
+        try:
+            fcntl.flock(part_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Часть уже загружается', 409, offset=os.fstat(fd).st_size)
+        yield part_file
+
+
+def write_chunk(upload_id, user_id, offset, stream):
+    """Дописывает часть из потока запроса прямо в .part, не буферизуя тело целиком"""
+    meta, _, part_path = _load(upload_id, user_id)
+    with _locked_part(part_path) as part_file:
+        # Смещение проверяется заново под блокировкой
+        current = os.fstat(part_file.fileno()).st_size
+        if offset != current:
+            raise UploadError('Неверное смещение части', 409, offset=current)
+
+        remaining = meta['size'] - offset
+        written = 0
+        while True:
+            block = stream.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            if written + len(block) > remaining:
+                part_file.write(block[:remaining - written])
+                raise UploadError('Часть выходит за объявленный размер файла', 400, offset=meta['size'])
+            part_file.write(block)
+            written += len(block)
+    return offset + written
+
+
+@contextmanager
+def finalize_upload(upload_id, user_id):
+    """Кладет собранный файл в хранилище и отдает метаданные загрузки с хешем блоку with.
+
+    Загрузка удаляется только после успешного выхода из блока (commit сообщения): при
+    ошибке .part и метаданные остаются, и завершение можно повторить. Блокировка .part
+    держится до конца блока - параллельное завершение получает 409.
+    """
+    meta, meta_path, part_path = _load(upload_id, user_id)
+    with _locked_part(part_path) as part_file:
+        size = os.fstat(part_file.fileno()).st_size
+        if size != meta['size']:
+            raise UploadError('Файл загружен не полностью', 409, offset=size)
+        meta['sha256'], meta['size'] = store_file(part_path)
+        yield meta
+        os.remove(part_path)
+        os.remove(meta_path)
+
+
+def discard_upload(upload_id, user_id):
+    _, meta_path, part_path = _load(upload_id, user_id)
+    for path in (part_path, meta_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def cleanup_partial_uploads(app):
+    """Удаляет незавершенные загрузки, к которым не обращались дольше UPLOAD_PARTIAL_TTL часов"""
+    partial_dir = os.path.join(app.config['UPLOAD_FOLDER'], PARTIAL_DIR)
+    if not os.path.isdir(partial_dir):
+        return 0
+
+    expiration = time.time() - app.config['UPLOAD_PARTIAL_TTL'] * 3600
+    removed = 0
+    for name in os.listdir(partial_dir):
+        upload_id, ext = os.path.splitext(name)
+        if ext != '.json':
+            continue
+        meta_path = os.path.join(partial_dir, name)
+        part_path = os.path.join(partial_dir, upload_id + '.part')
+        try:
+            # Последняя активность - запись очередной части в .part
+            paths = [path for path in (meta_path, part_path) if os.path.exists(path)]
+            if max(os.path.getmtime(path) for path in paths) < expiration:
+                for path in paths:
+                    os.remove(path)
+                removed += 1
+        except OSError as e:
+            print(f"⚠️ Ошибка удаления незавершенной загрузки {upload_id}: {str(e)}")
+    if removed:
+        print(f"🧹 Удалено незавершенных загрузок: {removed}")
+    return removed
@@ -1,12 +1,16 @@
-import os
+import base64
+import binascii
 import datetime
-from sqlalchemy import inspect
-from flask import current_app
+import threading
+import time
+from sqlalchemy import inspect, and_, case, func, or_, select, text, union_all
+from sqlalchemy.exc import IntegrityError
+from flask import current_app, g, session
 from extensions import db
-from models import File
-
-# Глобальный словарь для отслеживания активных пользователей
-active_users = {}
+from models import File, Message, User, Conversation, SchemaVersion
+from presence import presence
+from thumbnails import thumbnails
+from search import create_search_index, rebuild_search_index, index_message
 
 
 def get_chat_room_name(user1_id, user2_id):
@@ -16,73 +20,599 @@ def get_chat_room_name(user1_id, user2_id):
     return f"chat_{sorted_ids[0]}_{sorted_ids[1]}"
 
 
-def update_online_users(socketio):
-    """Отправляет обновленный список онлайн-пользователей всем клиентам"""
-    online_user_ids = list(active_users.keys())
-    from models import User
-    online_users = User.query.filter(User.id.in_(online_user_ids)).all()
+def encode_cursor(timestamp, item_id):
+    """Курсор keyset-пагинации по (timestamp, id)"""
+    raw = f"{timestamp.isoformat()}|{item_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
 
-    users_data = [{
-        'id': user.id,
-        'username': user.username,
-        'fullname': user.fullname,
-        'department': user.department or '',
-        'position': user.position or ''
-    } for user in online_users]
 
-    socketio.emit('online_users_update', {'users': users_data, 'online_ids': online_user_ids})
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, item_id = raw.split('|', 1)
+        return datetime.datetime.fromisoformat(timestamp), int(item_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Некорректный курсор: {cursor}")
 
 
-def init_database(db, app):
-    with app.app_context():
-        db.create_all()
-        inspector = inspect(db.engine)
-
-        tables = {
-            'message': ['is_read'],
-            'file': ['message_id', 'filesize']
-        }
-
-        for table_name, columns in tables.items():
-            if table_name in inspector.get_table_names():
-                existing_columns = [col['name'] for col in inspector.get_columns(table_name)]
-                for column in columns:
-                    if column not in existing_columns:
-                        try:
-                            with db.engine.begin() as connection:
-                                if column == 'is_read':
-                                    connection.execute(
-                                        f"ALTER TABLE {table_name} ADD COLUMN {column} BOOLEAN DEFAULT 0")
-                                elif column == 'filesize':
-                                    connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} BIGINT DEFAULT 0")
-                                else:
-                                    connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} INTEGER")
-                            print(f"✅ Добавлен столбец {column} в таблицу {table_name}")
-                        except Exception as e:
-                            print(f"❌ Ошибка добавления столбца {column}: {str(e)}")
+def keyset_before(timestamp_column, id_column, cursor):
+    timestamp, item_id = cursor
+    return or_(timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < item_id))
 
-        print("🛢️ Инициализация схемы базы данных завершена")
+
+def keyset_after(timestamp_column, id_column, cursor):
+    timestamp, item_id = cursor
+    return or_(timestamp_column > timestamp, and_(timestamp_column == timestamp, id_column > item_id))
+
+
+# Кэш профильных полей для событий присутствия: рассылка не делает запрос к БД
+_presence_profiles = {}
+_presence_profiles_lock = threading.Lock()
+
+
+def get_presence_profiles(user_ids):
+    """Профили пользователей для событий присутствия; недостающие загружаются одним запросом"""
+    now = time.monotonic()
+    profiles = {}
+    missing = []
+    with _presence_profiles_lock:
+        for user_id in user_ids:
+            cached = _presence_profiles.get(user_id)
+            if cached and cached[1] > now:
+                profiles[user_id] = cached[0]
+            else:
+                missing.append(user_id)
+
+    if missing:
+        expires_at = now + current_app.config['PRESENCE_PROFILE_TTL']
+        rows = db.session.query(User.id, User.username, User.fullname, User.department, User.position) \
+            .filter(User.id.in_(missing)).all()
+        with _presence_profiles_lock:
+            for row in rows:
+                profile = {
+                    'id': row.id,
+                    'username': row.username,
+                    'fullname': row.fullname,
+                    'department': row.department or '',
+                    'position': row.position or ''
+                }
+                _presence_profiles[row.id] = (profile, expires_at)
+                profiles[row.id] = profile
+
+    return [profiles[user_id] for user_id in user_ids if user_id in profiles]
+
+
+def invalidate_presence_profiles():
+    with _presence_profiles_lock:
+        _presence_profiles.clear()
+
+
+def get_presence_snapshot():
+    """Текущий список онлайн-пользователей; отправляется только подключившемуся клиенту"""
+    return get_presence_profiles(sorted(presence.online_ids()))
+
+
+# Изменения присутствия накапливаются в пределах окна PRESENCE_DEBOUNCE и рассылаются
+# дельтами presence_join/presence_leave вместо полного списка на каждое подключение
+_presence_changes = {'joined': set(), 'left': set(), 'scheduled': False}
+_presence_changes_lock = threading.Lock()
+
+
+def queue_presence_change(socketio, joined=(), left=()):
+    app = current_app._get_current_object()
+    with _presence_changes_lock:
+        # Вход и выход одного пользователя в пределах окна (перезагрузка вкладки) взаимно гасятся
+        for user_id in joined:
+            if user_id in _presence_changes['left']:
+                _presence_changes['left'].discard(user_id)
+            else:
+                _presence_changes['joined'].add(user_id)
+        for user_id in left:
+            if user_id in _presence_changes['joined']:
+                _presence_changes['joined'].discard(user_id)
+            else:
+                _presence_changes['left'].add(user_id)
+        if _presence_changes['scheduled']:
+            return
+        _presence_changes['scheduled'] = True
+    socketio.start_background_task(_flush_presence_changes, socketio, app)
+
+
+def _flush_presence_changes(socketio, app):
+    socketio.sleep(app.config['PRESENCE_DEBOUNCE'])
+    with _presence_changes_lock:
+        joined = _presence_changes['joined']
+        left = _presence_changes['left']
+        _presence_changes.update(joined=set(), left=set(), scheduled=False)
+
+    if joined:
+        try:
+            with app.app_context():
+                users = get_presence_profiles(sorted(joined))
+            socketio.emit('presence_join', {'users': users})
+        except Exception as e:
+            print(f"⚠️ Ошибка рассылки presence_join: {str(e)}")
+    if left:
+        socketio.emit('presence_leave', {'user_ids': sorted(left)})
+
+
+# Фоновая очистка сессий, переставших присылать heartbeat (вкладка закрыта без disconnect,
+# упал воркер); запускается один раз на процесс при первом подключении
+_presence_sweeper = {'started': False}
+_presence_sweeper_lock = threading.Lock()
+
+
+def start_presence_sweeper(socketio):
+    app = current_app._get_current_object()
+    with _presence_sweeper_lock:
+        if _presence_sweeper['started']:
+            return
+        _presence_sweeper['started'] = True
+    socketio.start_background_task(_sweep_presence, socketio, app)
+
+
+def _sweep_presence(socketio, app):
+    interval = max(app.config['PRESENCE_TTL'] // 3, 1)
+    while True:
+        socketio.sleep(interval)
+        try:
+            offline = presence.expire()
+            if offline:
+                print(f"⌛ Истекло присутствие пользователей: {sorted(offline)}")
+                with app.app_context():
+                    queue_presence_change(socketio, left=offline)
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки присутствия: {str(e)}")
+
+
+PREVIEW_LENGTH = 255
+
+
+def get_conversations(user_id):
+    """Диалоги пользователя из таблицы Conversation, отсортированные по последнему сообщению.
+
+    Возвращает список (conversation, user) и словарь непрочитанных по id собеседника.
+    """
+    rows = db.session.query(Conversation, User).join(
+        User, User.id == Conversation.peer_id
+    ).filter(
+        Conversation.user_id == user_id,
+        # Строка, созданная отметкой о прочтении до записи первого сообщения
+        Conversation.last_message_id.isnot(None)
+    ).order_by(Conversation.last_timestamp.desc(), Conversation.last_message_id.desc()).all()
+
+    unread_counts = {user.id: conversation.unread_count for conversation, user in rows}
+    return rows, unread_counts
+
+
+def _upsert_conversation(user_id, peer_id, message, unread_increment):
+    values = {
+        Conversation.last_message_id: message.id,
+        Conversation.last_sender_id: message.sender_id,
+        Conversation.last_timestamp: message.timestamp,
+        Conversation.preview: (message.content or '')[:PREVIEW_LENGTH],
+        Conversation.unread_count: Conversation.unread_count + unread_increment
+    }
+    query = Conversation.query.filter_by(user_id=user_id, peer_id=peer_id)
+    if query.update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Conversation(
+                user_id=user_id,
+                peer_id=peer_id,
+                last_message_id=message.id,
+                last_sender_id=message.sender_id,
+                last_timestamp=message.timestamp,
+                preview=(message.content or '')[:PREVIEW_LENGTH],
+                unread_count=unread_increment
+            ))
+    except IntegrityError:
+        # Первое сообщение диалога одновременно записала параллельная транзакция
+        query.update(values, synchronize_session=False)
+
+
+def _adjust_unread(user_id, peer_id, delta):
+    """Сдвигает счетчики непрочитанных диалога и пользователя, не опуская их ниже нуля"""
+    if delta > 0:
+        User.query.filter_by(id=user_id).update(
+            {User.unread_count: func.coalesce(User.unread_count, 0) + delta}, synchronize_session=False)
+        return
+    decrement = -delta
+    Conversation.query.filter_by(user_id=user_id, peer_id=peer_id).update(
+        {Conversation.unread_count: case(
+            (Conversation.unread_count > decrement, Conversation.unread_count - decrement),
+            else_=0
+        )}, synchronize_session=False)
+    User.query.filter_by(id=user_id).update(
+        {User.unread_count: case(
+            (User.unread_count > decrement, User.unread_count - decrement),
+            else_=0
+        )}, synchronize_session=False)
+
+
+def record_message(message, filenames=()):
+    """Обновляет диалоги отправителя и получателя и поисковый индекс в той же транзакции, что и сообщение"""
+    if message.id is None or message.timestamp is None:
+        db.session.flush()
+
+    index_message(message, filenames)
+
+    unread_increment = 0 if message.is_read else 1
+    if message.sender_id != message.recipient_id:
+        _upsert_conversation(message.sender_id, message.recipient_id, message, 0)
+    _upsert_conversation(message.recipient_id, message.sender_id, message, unread_increment)
+    if unread_increment:
+        _adjust_unread(message.recipient_id, message.sender_id, unread_increment)
+
+
+def record_read(user_id, peer_id, count=None):
+    """Уменьшает счетчики непрочитанных в диалоге и у пользователя (count=None - обнуляет диалог)"""
+    unread = db.session.query(Conversation.unread_count).filter_by(
+        user_id=user_id, peer_id=peer_id).scalar() or 0
+    delta = unread if count is None else min(count, unread)
+    if delta > 0:
+        _adjust_unread(user_id, peer_id, -delta)
+
+
+def _advance_read_watermark(reader_id, peer_id, up_to_id):
+    """Сдвигает Conversation.last_read_id читателя вперед до up_to_id.
+
+    В режиме write-behind клиент может прочитать сообщение раньше, чем оно записано:
+    писатель сверяется с этой отметкой и сохраняет такие сообщения уже прочитанными.
+    """
+    values = {Conversation.last_read_id: case(
+        (Conversation.last_read_id > up_to_id, Conversation.last_read_id),
+        else_=up_to_id
+    )}
+    query = Conversation.query.filter_by(user_id=reader_id, peer_id=peer_id)
+    if query.update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Conversation(user_id=reader_id, peer_id=peer_id, unread_count=0, last_read_id=up_to_id))
+    except IntegrityError:
+        # Строку диалога только что добавил писатель сообщений
+        query.update(values, synchronize_session=False)
+
+
+def mark_read_up_to(reader_id, peer_id, up_to_id=None):
+    """Помечает прочитанными все сообщения собеседника до up_to_id включительно одним UPDATE"""
+    if up_to_id is not None:
+        # Отметка раньше UPDATE сообщений: блокировка строки диалога упорядочивает их с писателем
+        _advance_read_watermark(reader_id, peer_id, up_to_id)
+
+    query = Message.query.filter(
+        Message.sender_id == peer_id,
+        Message.recipient_id == reader_id,
+        Message.is_read == False
+    )
+    if up_to_id is not None:
+        query = query.filter(Message.id <= up_to_id)
+
+    updated = query.update({Message.is_read: True}, synchronize_session=False)
+    if up_to_id is None:
+        record_read(reader_id, peer_id)
+    else:
+        record_read(reader_id, peer_id, updated)
+    return updated
+
+
+def get_current_user():
+    """Текущий пользователь, загружается не чаще одного раза за запрос"""
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g or g.current_user is None or g.current_user.id != session['user_id']:
+        g.current_user = db.session.get(User, session['user_id'])
+    return g.current_user
+
+
+def set_current_user(user):
+    g.current_user = user
+
+
+def get_unread_total():
+    """Общее число непрочитанных сообщений текущего пользователя из счетчика User.unread_count"""
+    user = get_current_user()
+    return (user.unread_count or 0) if user else 0
 
 
-def cleanup_old_files(app):
+def recount_unread_totals():
+    """Пересчитывает User.unread_count как сумму непрочитанных по диалогам"""
+    totals = select(func.coalesce(func.sum(Conversation.unread_count), 0)).where(
+        Conversation.user_id == User.id
+    ).scalar_subquery()
+    User.query.update({User.unread_count: totals}, synchronize_session=False)
+
+
+def rebuild_conversations(batch_size=1000, recount_totals=True):
+    """Пересобирает таблицу Conversation по существующим сообщениям"""
+    sides = union_all(
+        select(
+            Message.sender_id.label('user_id'),
+            Message.recipient_id.label('peer_id'),
+            Message.id.label('message_id'),
+            Message.sender_id.label('sender_id'),
+            Message.timestamp.label('timestamp'),
+            Message.content.label('content')
+        ),
+        select(
+            Message.recipient_id.label('user_id'),
+            Message.sender_id.label('peer_id'),
+            Message.id.label('message_id'),
+            Message.sender_id.label('sender_id'),
+            Message.timestamp.label('timestamp'),
+            Message.content.label('content')
+        ).where(Message.sender_id != Message.recipient_id)
+    ).subquery()
+
+    ranked = select(
+        sides,
+        func.row_number().over(
+            partition_by=(sides.c.user_id, sides.c.peer_id),
+            order_by=(sides.c.timestamp.desc(), sides.c.message_id.desc())
+        ).label('position')
+    ).subquery()
+
+    unread = {
+        (recipient_id, sender_id): count
+        for recipient_id, sender_id, count in db.session.query(
+            Message.recipient_id, Message.sender_id, func.count(Message.id)
+        ).filter(Message.is_read == False).group_by(Message.recipient_id, Message.sender_id)
+    }
+
+    Conversation.query.delete(synchronize_session=False)
+
+    rows = db.session.execute(select(ranked).where(ranked.c.position == 1)).all()
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append({
+            'user_id': row.user_id,
+            'peer_id': row.peer_id,
+            'last_message_id': row.message_id,
+            'last_sender_id': row.sender_id,
+            'last_timestamp': row.timestamp,
+            'preview': (row.content or '')[:PREVIEW_LENGTH],
+            'unread_count': unread.get((row.user_id, row.peer_id), 0)
+        })
+        if len(batch) >= batch_size:
+            db.session.bulk_insert_mappings(Conversation, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        db.session.bulk_insert_mappings(Conversation, batch)
+        total += len(batch)
+
+    if recount_totals:
+        recount_unread_totals()
+    db.session.commit()
+    print(f"💬 Таблица диалогов пересобрана: {total} записей")
+    return total
+
+
+def _add_columns(connection, table_name, columns):
+    inspector = inspect(connection)
+    if table_name not in inspector.get_table_names():
+        return
+    existing_columns = {col['name'] for col in inspector.get_columns(table_name)}
+    quoted_table = connection.dialect.identifier_preparer.quote(table_name)
+    for column, ddl in columns:
+        if column not in existing_columns:
+            connection.execute(text(f"ALTER TABLE {quoted_table} ADD COLUMN {column} {ddl}"))
+            print(f"✅ Добавлен столбец {column} в таблицу {table_name}")
+
+
+def _migration_legacy_columns(db):
+    with db.engine.begin() as connection:
+        _add_columns(connection, 'message', [('is_read', 'BOOLEAN DEFAULT FALSE')])
+        _add_columns(connection, 'file', [('message_id', 'INTEGER'), ('filesize', 'BIGINT DEFAULT 0')])
+
+
+def _migration_user_is_admin(db):
+    with db.engine.begin() as connection:
+        _add_columns(connection, 'user', [('is_admin', 'BOOLEAN DEFAULT FALSE')])
+
+
+def _create_indexes(connection, indexes):
+    """Создает индексы [(имя, таблица, столбцы)]; шаг миграции перечисляет их явно,
+    а не берет из текущей модели - там могут быть столбцы, добавляемые позже"""
+    preparer = connection.dialect.identifier_preparer
+    for name, table_name, columns in indexes:
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {preparer.quote(name)} ON {preparer.quote(table_name)} "
+            f"({', '.join(preparer.quote(column) for column in columns)})"
+        ))
+
+
+def _migration_hot_path_indexes(db):
+    with db.engine.begin() as connection:
+        _create_indexes(connection, [
+            ('ix_message_timestamp', 'message', ['timestamp']),
+            ('ix_message_recipient_is_read', 'message', ['recipient_id', 'is_read']),
+            ('ix_message_sender_recipient_timestamp', 'message', ['sender_id', 'recipient_id', 'timestamp']),
+            ('ix_message_recipient_sender_timestamp', 'message', ['recipient_id', 'sender_id', 'timestamp']),
+            ('ix_file_upload_date', 'file', ['upload_date']),
+            ('ix_file_message_id', 'file', ['message_id']),
+            ('ix_conversation_user_last_timestamp', 'conversation', ['user_id', 'last_timestamp']),
+        ])
+
+
+def _migration_user_unread_count(db):
+    with db.engine.begin() as connection:
+        _add_columns(connection, 'user', [('unread_count', 'INTEGER DEFAULT 0')])
+    recount_unread_totals()
+    db.session.commit()
+
+
+def _migration_file_blob_hash(db):
+    with db.engine.begin() as connection:
+        _add_columns(connection, 'file', [('blob_hash', 'VARCHAR(64)')])
+        _create_indexes(connection, [('ix_file_blob_hash', 'file', ['blob_hash'])])
+
+
+def _migration_search_index(db):
+    with db.engine.begin() as connection:
+        create_search_index(connection)
+    if db.session.query(Message.id).first():
+        rebuild_search_index()
+
+
+def _migration_conversation_last_read(db):
+    with db.engine.begin() as connection:
+        _add_columns(connection, 'conversation', [('last_read_id', 'INTEGER')])
+
+
+def _migration_conversations_backfill(db):
+    has_conversations = db.session.query(Conversation.id).first()
+    has_messages = db.session.query(Message.id).first()
+    if has_messages and not has_conversations:
+        # Столбец user.unread_count появляется только в миграции 5, она же пересчитывает итоги
+        rebuild_conversations(recount_totals=False)
+
+
+# Версионированные шаги миграции: (версия, описание, функция(db)).
+# Шаги идемпотентны - базы, созданные до появления версий, проходят их безопасно.
+MIGRATIONS = [
+    (1, 'Столбцы message.is_read, file.message_id, file.filesize', _migration_legacy_columns),
+    (2, 'Столбец user.is_admin', _migration_user_is_admin),
+    (3, 'Составные индексы Message, File и Conversation', _migration_hot_path_indexes),
+    (4, 'Заполнение таблицы диалогов', _migration_conversations_backfill),
+    (5, 'Счетчик непрочитанных user.unread_count', _migration_user_unread_count),
+    (6, 'Столбец file.blob_hash для хранилища по хешу', _migration_file_blob_hash),
+    (7, 'Полнотекстовый индекс сообщений', _migration_search_index),
+    (8, 'Столбец conversation.last_read_id', _migration_conversation_last_read),
+]
+
+
+def run_migrations(db):
+    current = db.session.query(func.max(SchemaVersion.version)).scalar() or 0
+    db.session.commit()
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            migration(db)
+            db.session.add(SchemaVersion(version=version, description=description))
+            db.session.commit()
+            print(f"🛢️ Применена миграция {version}: {description}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Ошибка миграции {version} ({description}): {str(e)}")
+            raise
+
+
+# Отложенная отправка счетчиков непрочитанных: обновления одного пользователя
+# в пределах окна UNREAD_PUSH_WINDOW объединяются в одно событие
+_unread_push = {'pending': set(), 'scheduled': False}
+_unread_push_lock = threading.Lock()
+
+
+def push_unread_counts(socketio, *user_ids):
+    """Планирует отправку актуального счетчика непрочитанных в комнаты user_<id>"""
+    app = current_app._get_current_object()
+    with _unread_push_lock:
+        _unread_push['pending'].update(int(user_id) for user_id in user_ids)
+        if _unread_push['scheduled']:
+            return
+        _unread_push['scheduled'] = True
+    socketio.start_background_task(_flush_unread_counts, socketio, app)
+
+
+def _flush_unread_counts(socketio, app):
+    socketio.sleep(app.config['UNREAD_PUSH_WINDOW'])
+    with _unread_push_lock:
+        user_ids = _unread_push['pending']
+        _unread_push['pending'] = set()
+        _unread_push['scheduled'] = False
+
+    if not user_ids:
+        return
+
+    try:
+        with app.app_context():
+            counts = db.session.query(User.id, User.unread_count).filter(User.id.in_(user_ids)).all()
+    except Exception as e:
+        print(f"⚠️ Ошибка получения счетчиков непрочитанных: {str(e)}")
+        return
+
+    for user_id, count in counts:
+        socketio.emit('unread_count', {'count': count or 0}, room=f"user_{user_id}")
+
+
+def emit_messages_read(socketio, reader_id, peer_id, up_to_id, count):
+    """Одно агрегированное событие о прочтении диапазона сообщений вместо события на каждое"""
+    socketio.emit('messages_read', {
+        'reader_id': reader_id,
+        'sender_id': peer_id,
+        'up_to_id': up_to_id,
+        'count': count
+    }, room=get_chat_room_name(reader_id, peer_id))
+
+    socketio.emit('inbox_update', {
+        'user_id': reader_id,
+        'sender_id': peer_id,
+        'is_read_update': True,
+        'read_count': count,
+        'up_to_id': up_to_id
+    }, room=f"user_{reader_id}")
+
+    push_unread_counts(socketio, reader_id)
+
+
+def build_message_payload(message, files=()):
+    """Каноническое представление нового сообщения, общее для всех событий рассылки.
+
+    Вызывается после flush и до commit: id и время уже назначены, а атрибуты
+    еще не сброшены, поэтому повторных запросов к сообщению нет.
+    """
+    sender = get_presence_profiles([message.sender_id])
+    return {
+        'id': message.id,
+        'message_id': message.id,
+        'sender_id': int(message.sender_id),
+        'recipient_id': int(message.recipient_id),
+        'sender_name': sender[0]['fullname'] if sender else '',
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat() + 'Z',
+        'room': get_chat_room_name(message.sender_id, message.recipient_id),
+        'is_read': message.is_read,
+        'files': [{
+            'id': f.id,
+            'filename': f.filename,
+            'filesize': f.filesize,
+            **thumbnails.preview_urls(f)
+        } for f in files]
+    }
+
+
+def dispatch_message(socketio, payload, sid=None, temp_id=None, push_unread=True):
+    """Рассылает новое сообщение одним emit: payload кодируется один раз"""
+    sender_id = payload['sender_id']
+    recipient_id = payload['recipient_id']
+
+    # Комната чата и личные комнаты участников; сокет, состоящий в нескольких из них,
+    # получает событие один раз. Чат, уведомление и список диалогов слушают new_message
+    socketio.emit('new_message', payload,
+                  room=[payload['room'], f"user_{sender_id}", f"user_{recipient_id}"])
+
+    if sid:
+        socketio.emit('message_delivered', {
+            'temp_id': temp_id,
+            'message_id': payload['id'],
+            'timestamp': payload['timestamp']
+        }, room=sid)
+
+    if push_unread:
+        push_unread_counts(socketio, recipient_id)
+
+
+def init_database(db, app):
     with app.app_context():
-        expiration = datetime.datetime.utcnow() - datetime.timedelta(days=app.config['FILE_LIFETIME'])
-        old_files = File.query.filter(File.upload_date < expiration).all()
-
-        deleted_count = 0
-        for file in old_files:
-            try:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    print(f"🗑️ Удален файл: {file.filename}")
-                db.session.delete(file)
-                deleted_count += 1
-            except OSError as e:
-                print(f"⚠️ Ошибка удаления файла {file.filename}: {str(e)}")
-
-        db.session.commit()
-        print(f"🧹 Очищено {deleted_count} старых файлов")
+        db.create_all()
+        run_migrations(db)
+        print("🛢️ Инициализация схемы базы данных завершена")
 
 
 def filesizeformat_filter(value):